@@ -0,0 +1,101 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from evaluate import iou_matrix
+from my_post_process import layout_one, mask_from_png
+
+'''
+Speed and agreement of the text engines of layout_one.
+
+    python bench_xycut.py ../img/ --repeat 3
+
+Every name.jpg of the directory is laid out with its mask, read from the
+colored prediction name.png. Agreement is the share of the text boxes of one
+engine which have a text box of the other with IoU >= 0.5.
+'''
+
+
+ENGINES = ['rlsa', 'xycut']
+
+
+def agreement(bboxs1, bboxs2, iou_thresh=0.5):
+    ''' Share of bboxs1 matched by a box of bboxs2 '''
+
+    if len(bboxs1) == 0:
+        return 1.0
+    if len(bboxs2) == 0:
+        return 0.0
+    iou = iou_matrix(np.float64(bboxs1), np.float64(bboxs2))
+    return float(np.mean(iou.max(axis=1) >= iou_thresh))
+
+
+def bench(img_dir, repeat=3, **kwargs):
+    '''
+    kwargs: parameters of layout_one
+    return: one row per page {'name', 'seconds': {engine}, 'boxes': {engine},
+            'rlsa_in_xycut', 'xycut_in_rlsa'}
+    '''
+    names = sorted(f[:-len('.jpg')] for f in os.listdir(img_dir)
+                   if f.endswith('.jpg') and
+                   os.path.exists(os.path.join(img_dir, f[:-len('.jpg')] + '.png')))
+
+    rows = []
+    for name in names:
+        img = np.array(Image.open(os.path.join(img_dir, name + '.jpg')).convert('RGB'))
+        mask = mask_from_png(os.path.join(img_dir, name + '.png'))
+
+        seconds, text = {}, {}
+        for engine in ENGINES:
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                bboxs, labels, _ = layout_one(img, mask, engine=engine, **kwargs)
+                times.append(time.perf_counter() - start)
+            seconds[engine] = min(times)
+            text[engine] = bboxs[labels == 1]
+
+        rows.append({'name': name, 'seconds': seconds,
+                     'boxes': {engine: len(text[engine]) for engine in ENGINES},
+                     'rlsa_in_xycut': agreement(text['rlsa'], text['xycut']),
+                     'xycut_in_rlsa': agreement(text['xycut'], text['rlsa'])})
+    return rows
+
+
+def print_rows(rows):
+
+    print('%-24s %9s %9s %7s %6s %6s %8s %8s' % (
+        'page', 'rlsa s', 'xycut s', 'speedup', 'rlsa', 'xycut',
+        'r in x', 'x in r'))
+    for row in rows:
+        print('%-24s %9.4f %9.4f %6.1fx %6d %6d %8.2f %8.2f' % (
+            row['name'][:24], row['seconds']['rlsa'], row['seconds']['xycut'],
+            row['seconds']['rlsa'] / row['seconds']['xycut'],
+            row['boxes']['rlsa'], row['boxes']['xycut'],
+            row['rlsa_in_xycut'], row['xycut_in_rlsa']))
+
+    if rows:
+        total = {engine: sum(row['seconds'][engine] for row in rows) for engine in ENGINES}
+        print('%-24s %9.4f %9.4f %6.1fx %6s %6s %8.2f %8.2f' % (
+            'total / mean', total['rlsa'], total['xycut'], total['rlsa'] / total['xycut'],
+            '', '', np.mean([row['rlsa_in_xycut'] for row in rows]),
+            np.mean([row['xycut_in_rlsa'] for row in rows])))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark of the text engines')
+    parser.add_argument('img_dir', nargs='?', default='../img/')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-roi', action='store_true',
+                        help='run the rlsa on the full page')
+    args = parser.parse_args()
+
+    print_rows(bench(args.img_dir, args.repeat, roi=not args.no_roi))
+
+
+if __name__ == '__main__':
+    main()
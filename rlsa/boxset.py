@@ -0,0 +1,110 @@
+import numpy as np
+
+
+class BoxSet(object):
+    '''
+    Boxes of a page as growable columns:
+        bboxs   (N, 4) int32, y0, x0, y1, x1
+        labels  (N,)   int32
+        confs   (N,)   float32
+    Storage is preallocated and doubled when full, the properties are views
+    of the first N rows.
+    '''
+
+    def __init__(self, capacity=16):
+
+        capacity = max(int(capacity), 1)
+        self._bboxs = np.zeros((capacity, 4), np.int32)
+        self._labels = np.zeros(capacity, np.int32)
+        self._confs = np.zeros(capacity, np.float32)
+        self.size = 0
+
+    @classmethod
+    def from_arrays(cls, bboxs, labels, confs=0):
+
+        bboxs = np.reshape(bboxs, (-1, 4))
+        boxes = cls(len(bboxs))
+        boxes.extend(bboxs, labels, confs)
+        return boxes
+
+    @staticmethod
+    def concatenate(boxsets):
+
+        boxes = BoxSet(sum(len(b) for b in boxsets))
+        for b in boxsets:
+            boxes.extend(b.bboxs, b.labels, b.confs)
+        return boxes
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def bboxs(self):
+        return self._bboxs[:self.size]
+
+    @property
+    def labels(self):
+        return self._labels[:self.size]
+
+    @property
+    def confs(self):
+        return self._confs[:self.size]
+
+    def arrays(self):
+        ''' return: bboxs, labels, confs '''
+        return self.bboxs, self.labels, self.confs
+
+    def reserve(self, n):
+        ''' Make room for n more boxes '''
+
+        capacity = len(self._labels)
+        if self.size + n <= capacity:
+            return
+        while capacity < self.size + n:
+            capacity *= 2
+
+        for name in ('_bboxs', '_labels', '_confs'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def append(self, bbox, label, conf=0):
+
+        self.reserve(1)
+        self._bboxs[self.size] = bbox
+        self._labels[self.size] = label
+        self._confs[self.size] = conf
+        self.size += 1
+
+    def extend(self, bboxs, labels, confs=0):
+        ''' labels and confs may be scalars shared by all the boxes '''
+
+        n = len(bboxs)
+        self.reserve(n)
+        self._bboxs[self.size:self.size + n] = bboxs
+        self._labels[self.size:self.size + n] = labels
+        self._confs[self.size:self.size + n] = confs
+        self.size += n
+
+    def heights(self):
+        return self.bboxs[:, 2] - self.bboxs[:, 0]
+
+    def widths(self):
+        return self.bboxs[:, 3] - self.bboxs[:, 1]
+
+    def areas(self):
+        return self.heights() * self.widths()
+
+    def select(self, idx):
+        ''' New BoxSet with the boxes given by a bool mask or indexes '''
+
+        return BoxSet.from_arrays(self.bboxs[idx], self.labels[idx], self.confs[idx])
+
+    def filter_size(self, min_height=0, min_width=0, min_area=0):
+        ''' Keep the boxes strictly larger than the given sizes '''
+
+        heights, widths = self.heights(), self.widths()
+        keep = (heights > min_height) & (widths > min_width) & \
+            (heights * widths > min_area)
+        return self.select(keep)
@@ -0,0 +1,39 @@
+import time
+
+'''
+Per-page time budget.
+
+A stage with a cheaper fallback calls expired(deadline, name) before its
+expensive work, and takes the fallback once the budget of the page is spent.
+The names of those stages are kept in deadline.degraded, so the pages whose
+boxes come from a fallback can be reported.
+'''
+
+
+def expired(deadline, name):
+    ''' deadline.expired(name), or False when there is no deadline '''
+
+    return deadline is not None and deadline.expired(name)
+
+
+class Deadline(object):
+    ''' Budget of one page, in seconds from its creation. '''
+
+    def __init__(self, seconds):
+
+        self.seconds = seconds
+        self.start = time.perf_counter()
+        self.degraded = []
+
+    def remaining(self):
+
+        return self.seconds - (time.perf_counter() - self.start)
+
+    def expired(self, name=None):
+        ''' True when the budget is spent, name is then recorded as degraded '''
+
+        if self.remaining() > 0:
+            return False
+        if name is not None and name not in self.degraded:
+            self.degraded.append(name)
+        return True
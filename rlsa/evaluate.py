@@ -0,0 +1,249 @@
+import os
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from post_process import CLASSES_LIST, NAME_LIST
+
+
+GT_NAMES = ['figure', 'table', 'formula']  # class names in POD annotations
+IOU_THRESHOLDS = (0.5, 0.6, 0.7, 0.8)
+
+
+class Boxes(object):
+    ''' Boxes of a whole set of pages, stored by column and grouped by page '''
+
+    def __init__(self, names, page, bboxs, labels, confs):
+        order = np.argsort(page, kind='stable')
+        self.names = list(names)
+        self.page = np.int32(page)[order]
+        self.bboxs = np.reshape(np.float64(bboxs), (-1, 4))[order]
+        self.labels = np.int32(labels)[order]
+        self.confs = np.float64(confs)[order]
+        self.offsets = np.searchsorted(self.page, np.arange(len(self.names) + 1))
+
+    def page_slice(self, i):
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+
+def load_gt(gt_dir, names):
+    ''' Read POD annotations (x0,x1,y0,y1\\tclass) of the given pages '''
+
+    page, bboxs, labels = [], [], []
+    for i, name in enumerate(names):
+        with open(os.path.join(gt_dir, name + '.txt'), 'r') as gt_file:
+            gt_lines = gt_file.readlines()
+        for gt_line in gt_lines:
+            if '\t' not in gt_line:
+                continue
+            coords, class_name = gt_line.rstrip('\n').split('\t')[:2]
+            if class_name not in GT_NAMES:
+                continue
+            x0, x1, y0, y1 = [float(v) for v in coords.split(',')]
+            page.append(i)
+            bboxs.append([y0, x0, y1, x1])
+            labels.append(GT_NAMES.index(class_name) + 1)
+
+    return Boxes(names, page, bboxs, labels, np.ones(len(labels)))
+
+
+def load_pred(pred_file, names=None):
+    ''' Read a submission xml written by post_process.write_xml '''
+
+    with open(pred_file, 'r', encoding='utf-8') as pred_xml:
+        text = pred_xml.read()
+    # write_xml uses an empty root tag, which is not well-formed xml
+    text = re.sub(r'<(/?)>', r'<\1root>', text)
+    root = ET.fromstring(text.split('?>', 1)[-1])
+
+    documents = [(document.get('filename').rsplit('.', 1)[0], document)
+                 for document in root.iter('document')]
+    if names is None:
+        names = [name for name, _ in documents]
+    index = {name: i for i, name in enumerate(names)}
+
+    page, bboxs, labels, confs = [], [], [], []
+    for name, document in documents:
+        if name not in index:
+            continue
+        for region in document:
+            if region.tag not in CLASSES_LIST:
+                continue
+            points = region.find('Coords').get('points').split(' ')
+            x0, y0 = [float(v) for v in points[0].split(',')]
+            x1, y1 = [float(v) for v in points[-1].split(',')]
+            page.append(index[name])
+            bboxs.append([y0, x0, y1, x1])
+            labels.append(CLASSES_LIST.index(region.tag) + 1)
+            confs.append(float(region.get('prob')))
+
+    return Boxes(names, page, bboxs, labels, confs)
+
+
+def iou_matrix(bboxs1, bboxs2):
+    ''' IoU between every pair of boxes, computed by broadcasting '''
+
+    top_left = np.maximum(bboxs1[:, None, 0:2], bboxs2[None, :, 0:2])
+    bottom_right = np.minimum(bboxs1[:, None, 2:4], bboxs2[None, :, 2:4])
+    inter = np.prod(np.maximum(bottom_right - top_left, 0), axis=2)
+
+    area1 = np.prod(bboxs1[:, 2:4] - bboxs1[:, 0:2], axis=1)
+    area2 = np.prod(bboxs2[:, 2:4] - bboxs2[:, 0:2], axis=1)
+    union = area1[:, None] + area2[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def match_page(args):
+    '''
+    Greedy matching of one page, predictions in descending confidence.
+    return: {label: (confs, tp of shape (num_thresholds, num_pred), num_gt)}
+    '''
+    gt_bboxs, gt_labels, bboxs, labels, confs, thresholds = args
+
+    matches = {}
+    for c in range(1, len(CLASSES_LIST) + 1):
+        gt_class = gt_bboxs[gt_labels == c]
+        pred_class = bboxs[labels == c]
+        conf_class = confs[labels == c]
+
+        order = np.argsort(-conf_class, kind='stable')
+        pred_class = pred_class[order]
+        conf_class = conf_class[order]
+
+        tp = np.zeros((len(thresholds), len(pred_class)), bool)
+        if len(gt_class) and len(pred_class):
+            iou = iou_matrix(pred_class, gt_class)
+            for t, thresh in enumerate(thresholds):
+                matched = np.zeros(len(gt_class), bool)
+                for i in range(len(pred_class)):
+                    candidates = np.where(matched, -1, iou[i])
+                    j = np.argmax(candidates)
+                    if candidates[j] >= thresh:
+                        matched[j] = True
+                        tp[t, i] = True
+
+        matches[c] = (conf_class, tp, len(gt_class))
+    return matches
+
+
+def merge_matches(pages, num_thresholds):
+    ''' match_page results of several pages, concatenated per class in page order '''
+
+    matches = {}
+    for c in range(1, len(CLASSES_LIST) + 1):
+        matches[c] = (
+            np.concatenate([np.zeros(0)] + [page[c][0] for page in pages]),
+            np.concatenate([np.zeros((num_thresholds, 0), bool)] +
+                           [page[c][1] for page in pages], axis=1),
+            sum(page[c][2] for page in pages))
+    return matches
+
+
+def match_pages(args):
+    '''
+    match_page on a range of pages, one task of evaluate
+    args: gt and pred columns of the range, each with its page offsets
+    return: merge_matches of the pages
+    '''
+    gt_bboxs, gt_labels, gt_offsets, bboxs, labels, confs, offsets, thresholds = args
+
+    pages = []
+    for i in range(len(offsets) - 1):
+        gs = slice(gt_offsets[i], gt_offsets[i + 1])
+        ps = slice(offsets[i], offsets[i + 1])
+        pages.append(match_page((gt_bboxs[gs], gt_labels[gs], bboxs[ps],
+                                 labels[ps], confs[ps], thresholds)))
+    return merge_matches(pages, len(thresholds))
+
+
+def average_precision(recall, precision):
+    ''' All-point interpolated AP (VOC 2010+) '''
+
+    recall = np.concatenate(([0.0], recall, [1.0]))
+    precision = np.concatenate(([0.0], precision, [0.0]))
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    idx = np.where(recall[1:] != recall[:-1])[0]
+    return np.sum((recall[idx + 1] - recall[idx]) * precision[idx + 1])
+
+
+def evaluate(gt, pred, thresholds=IOU_THRESHOLDS, workers=1):
+    '''
+    gt, pred: Boxes over the same page names.
+    return: {(class name, iou thresh): {precision, recall, f1, ap}},
+            ap is nan for a class without ground truth
+    '''
+    # Contiguous ranges of pages, a few per worker, so a task is a handful
+    # of array slices instead of one pickled task per page.
+    num_pages = len(gt.names)
+    pages_per_task = max(-(-num_pages // (4 * workers)), 1)
+    tasks = []
+    for start in range(0, num_pages, pages_per_task):
+        stop = min(start + pages_per_task, num_pages)
+        gs = slice(gt.offsets[start], gt.offsets[stop])
+        ps = slice(pred.offsets[start], pred.offsets[stop])
+        tasks.append((gt.bboxs[gs], gt.labels[gs], gt.offsets[start:stop + 1] - gt.offsets[start],
+                      pred.bboxs[ps], pred.labels[ps], pred.confs[ps],
+                      pred.offsets[start:stop + 1] - pred.offsets[start], thresholds))
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            ranges = list(executor.map(match_pages, tasks))
+    else:
+        ranges = [match_pages(task) for task in tasks]
+    matches = merge_matches(ranges, len(thresholds))
+
+    results = {}
+    for c in range(1, len(CLASSES_LIST) + 1):
+        confs, tp, num_gt = matches[c]
+
+        order = np.argsort(-confs, kind='stable')
+        for t, thresh in enumerate(thresholds):
+            tp_cum = np.cumsum(tp[t, order])
+            precision = tp_cum / np.maximum(np.arange(1, len(order) + 1), 1)
+            recall = tp_cum / max(num_gt, 1)
+
+            num_tp = tp_cum[-1] if len(tp_cum) else 0
+            p = num_tp / max(len(order), 1)
+            r = num_tp / max(num_gt, 1)
+            results[(NAME_LIST[c - 1], thresh)] = {
+                'precision': p,
+                'recall': r,
+                'f1': 2 * p * r / max(p + r, 1e-9),
+                # No ground truth, no AP: the class is left out of the mAP.
+                'ap': average_precision(recall, precision) if num_gt else np.nan,
+            }
+
+    return results
+
+
+def evaluate_dir(gt_dir, pred_file, thresholds=IOU_THRESHOLDS, workers=1):
+    ''' Score a submission xml against every annotation in gt_dir '''
+
+    names = sorted(f[:-len('.txt')] for f in os.listdir(gt_dir)
+                   if f.endswith('.txt'))
+    gt = load_gt(gt_dir, names)
+    pred = load_pred(pred_file, names)
+    return evaluate(gt, pred, thresholds, workers)
+
+
+def print_results(results):
+
+    print('%-10s %5s %9s %9s %9s %9s' %
+          ('class', 'iou', 'precision', 'recall', 'f1', 'ap'))
+    for (name, thresh), r in sorted(results.items()):
+        print('%-10s %5.2f %9.4f %9.4f %9.4f %9.4f' %
+              (name, thresh, r['precision'], r['recall'], r['f1'], r['ap']))
+
+    for thresh in sorted(set(t for _, t in results)):
+        mean_ap = np.nanmean([r['ap'] for (_, t), r in results.items() if t == thresh])
+        print('mAP@%.2f: %.4f' % (thresh, mean_ap))
+
+
+if __name__ == '__main__':
+
+    gt_dir = '../../pod/Test/Annotations/'
+    pred_file = '../pod_test/submission.xml'
+
+    print_results(evaluate_dir(gt_dir, pred_file, workers=os.cpu_count()))
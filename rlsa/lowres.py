@@ -0,0 +1,69 @@
+import numpy as np
+
+'''
+Masks at the stride of the network instead of the page size.
+
+A mask of scale s has one cell per s x s page pixels: page pixel (y, x) is
+cell (y // s, x // s), clamped to the last cell when the page is not a
+multiple of s. Argmax and labeling run on the cells, boxes are scaled to
+page pixels, and cells are only repeated to page pixels inside a box when a
+stage needs them pixel by pixel. Scale 1 is the plain page-size mask.
+'''
+
+
+def cells(start, stop, scale, size):
+    ''' Cell index of each page pixel of start:stop, size cells in total '''
+
+    return np.minimum(np.arange(start, stop) // scale, size - 1)
+
+
+def upsample_box(a, bbox, scale=1):
+    ''' a (cells, 2-d or more) at page pixels inside bbox (y0, x0, y1, x1), nearest '''
+
+    y0, x0, y1, x1 = bbox
+    if scale == 1:
+        return a[y0:y1, x0:x1]
+    rows = cells(y0, y1, scale, a.shape[0])
+    cols = cells(x0, x1, scale, a.shape[1])
+    return a[rows[:, None], cols[None, :]]
+
+
+def box_mean(mask, bbox, c, scale=1):
+    '''
+    Mean of channel c over the page pixels of bbox, same as on the upsampled
+    mask but each cell is weighted by its pixel count instead of repeated.
+    '''
+    y0, x0, y1, x1 = bbox
+    if scale == 1:
+        return np.mean(mask[y0:y1, x0:x1, c])
+    if y1 <= y0 or x1 <= x0:
+        return np.nan
+
+    rows, row_counts = np.unique(cells(y0, y1, scale, mask.shape[0]), return_counts=True)
+    cols, col_counts = np.unique(cells(x0, x1, scale, mask.shape[1]), return_counts=True)
+    block = np.float64(mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1, c])
+    return row_counts @ block @ col_counts / ((y1 - y0) * (x1 - x0))
+
+
+def scale_bboxs(bboxs, scale, shape):
+    ''' Boxes of cells to boxes of page pixels, clipped to the page shape (h, w) '''
+
+    if scale == 1:
+        return bboxs
+    bboxs = np.asarray(bboxs) * scale
+    bboxs[:, 0::2] = np.minimum(bboxs[:, 0::2], shape[0])
+    bboxs[:, 1::2] = np.minimum(bboxs[:, 1::2], shape[1])
+    return bboxs
+
+
+def check_scale(page_shape, mask_shape, scale):
+    '''
+    Raise ValueError unless the mask has the cells of a page of page_shape at
+    scale, page_size // scale or ceil(page_size / scale) along each axis.
+    '''
+    for page_size, mask_size in zip(page_shape[:2], mask_shape[:2]):
+        if not page_size // scale <= mask_size <= -(-page_size // scale):
+            guess = max(int(round(page_shape[0] / max(mask_shape[0], 1))), 1)
+            raise ValueError('mask of %dx%d does not fit a page of %dx%d at mask scale %d'
+                             ' (scale %d?)' % (mask_shape[0], mask_shape[1], page_shape[0],
+                                               page_shape[1], scale, guess))
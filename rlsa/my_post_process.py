@@ -1,9 +1,20 @@
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 from skimage import io, measure, filters
 from PIL import Image, ImageDraw, ImageFont
 
+from boxset import BoxSet
+from deadline import Deadline, expired
+from lowres import box_mean, check_scale, scale_bboxs, upsample_box
+from profiling import SlowPageCapture, stage
+from results import JsonlWriter
+
 '''
 2019/12/13
 by qidongxu
@@ -13,6 +24,8 @@ by qidongxu
 COLOR_LIST = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (120, 120, 0)]  # 画box时的颜色
 CLASSES_LIST = ['text', 'tableRegion', 'figureRegion', 'formulaRegion']
 NAME_LIST = ['text', 'table', 'figure', 'equation']
+# Colors of the background, text, table, figure and formula predictions (name.png).
+PALETTE = [(0, 0, 0), (128, 0, 0), (0, 128, 0), (128, 128, 0), (0, 0, 128)]
 
 
 def iteration(image: np.ndarray, value: int) -> np.ndarray:
@@ -71,6 +84,67 @@ def rlsa(image: np.ndarray, horizontal: bool = True, vertical: bool = True, valu
     return image
 
 
+def rlsa_runs(image: np.ndarray):
+    '''
+    Runs of non-zero pixels bounded by 0 on both sides, row by row.
+    return: (rows, starts, lengths), the runs "iteration" may convert to 0
+    '''
+    r, c = np.nonzero(image == 0)
+    gaps = c[1:] - c[:-1]
+    inner = (r[1:] == r[:-1]) & (gaps > 1)
+    return r[:-1][inner], c[:-1][inner] + 1, gaps[inner] - 1
+
+
+def rlsa_fill(image: np.ndarray, runs, value: int) -> np.ndarray:
+    '''
+    Same result as "iteration" on a copy of image, given its runs from rlsa_runs.
+    Only runs shorter than value are set to 0, so one set of runs serves any value.
+    '''
+    value = int(value) if value >= 0 else 0
+    rows, starts, lengths = runs
+    keep = lengths < value
+    image = np.copy(image)
+    if np.any(keep):
+        delta = np.zeros((image.shape[0], image.shape[1] + 1), np.int8)
+        delta[rows[keep], starts[keep]] = 1
+        delta[rows[keep], starts[keep] + lengths[keep]] = -1
+        image[np.cumsum(delta, axis=1, dtype=np.int8)[:, :-1] > 0] = 0
+    return image
+
+
+def rlsa_rows(image: np.ndarray, value: int) -> np.ndarray:
+    return rlsa_fill(image, rlsa_runs(image), value)
+
+
+def rlsa_bands(image: np.ndarray, value: int, executor=None, bands=4, min_rows=64) -> np.ndarray:
+    '''
+    Horizontal rlsa with the rows split into bands run on executor.
+    Rows are independent, so the result is the same as without executor.
+    '''
+    rows = image.shape[0]
+    if executor is None or rows < 2 * min_rows:
+        return rlsa_rows(image, value)
+    bands = min(bands, rows // min_rows)
+    edges = np.linspace(0, rows, bands + 1).astype(int)
+    futures = [executor.submit(rlsa_rows, image[a:b], value)
+               for a, b in zip(edges[:-1], edges[1:])]
+    return np.concatenate([future.result() for future in futures], axis=0)
+
+
+def rlsa_fast(image: np.ndarray, horizontal: bool = True, vertical: bool = True, value: int = 0,
+              executor=None) -> np.ndarray:
+    '''
+    Same result as rlsa, computed on runs (see rlsa_runs) instead of pixel by pixel.
+    The input image is not modified.
+    executor: optional thread pool, rows (columns for vertical) are split into bands
+    '''
+    if horizontal:
+        image = rlsa_bands(image, value, executor)
+    if vertical:
+        image = rlsa_bands(image.T, value, executor).T
+    return image
+
+
 def rlsa_res_by_mask(img_rlsa, mask_class):
     '''
     img_rlsa: img after rlsa;
@@ -78,62 +152,122 @@ def rlsa_res_by_mask(img_rlsa, mask_class):
     type: np, 2-d
     return: img restricted by mask
     '''
-    R, C = img_rlsa.shape
     rlsa_res = np.copy(img_rlsa)
-    for r in range(R):
-        for c in range(C):
-            if (rlsa_res[r, c] == 0) and (not mask_class[r, c]):
-                rlsa_res[r, c] = 255
+    rlsa_res[(rlsa_res == 0) & np.logical_not(mask_class)] = 255
     return rlsa_res
 
 
 #  针对文本用 rlsa
-def bbox_from_rlsa(img_rlsa, mask, label_num):
+def bbox_from_rlsa(img_rlsa, mask, label_num, mask_classes=None, scale=1):
     '''
     mask: 3-d, channel 1-5 分别是：背景，文本，表格，图片，公式
     label_num: 与mask channel对应， 0背景，1文本，2表格，3图片，4公式
-    return: bboxes: numpy格式的bbox
-            labels: label_num
+    mask_classes: argmax of mask, pass it in to share it between calls
+    scale: page pixels per mask cell (see lowres.py)
+    return: BoxSet of label_num, confs not set
     '''
-    mask_classes = np.argmax(mask, axis=2)
-    mask_class = (mask_classes == label_num)
+    if mask_classes is None:
+        mask_classes = np.argmax(mask, axis=2)
+    mask_class = upsample_box(mask_classes == label_num, (0, 0) + img_rlsa.shape, scale)
     img_rlsa_res = rlsa_res_by_mask(img_rlsa, mask_class)
     img_rlsa_res = 255 - img_rlsa_res  # 这里取决于二值化时，是否把背景设为白，如果是就需要翻转
     rlsa_label = measure.label(img_rlsa_res, connectivity=1)
     rlsa_props = measure.regionprops(rlsa_label)
-    rlsa_boxes = [r['bbox'] for r in rlsa_props]
-    rlsa_boxes = np.reshape(rlsa_boxes, (-1, 4))
-    # labels = np.int32([label_num] * len(rlsa_boxes))
-    return rlsa_boxes  # , labels
+    rlsa_boxes = BoxSet(len(rlsa_props))
+    for r in rlsa_props:
+        rlsa_boxes.append(r['bbox'], label_num)
+    return rlsa_boxes
+
+
+def text_regions(mask_classes, label_nums, pad=0):
+    '''
+    Regions around the pixels of label_nums, grown by pad pixels.
+    return: label image of the regions, bboxes of the regions
+    '''
+    roi = np.uint8(np.isin(mask_classes, label_nums))
+    if pad > 0:
+        roi = cv2.dilate(roi, cv2.getStructuringElement(
+            cv2.MORPH_RECT, (2 * pad + 1, 2 * pad + 1)))
+    region_label = measure.label(roi, connectivity=2)
+    regions = [(r['label'], r['bbox']) for r in measure.regionprops(region_label)]
+    return region_label, regions
+
+
+def bbox_from_rlsa_roi(img, mask_classes, label_nums, rlsa_thresh_h=15, rlsa_thresh_v=8,
+                       executor=None, scale=1):
+    '''
+    bbox_from_rlsa for each of label_nums, but the page is only binarized and
+    smoothed inside text_regions of label_nums.
+    Regions are padded by rlsa_thresh_h + rlsa_thresh_v so the rlsa is the same
+    as on the full page; the Otsu threshold is still the one of the full page.
+    executor: optional thread pool for rlsa_fast
+    scale: page pixels per mask cell, regions are found on the cells and the
+           mask is only upsampled inside them (see lowres.py)
+    return: list of BoxSet, one per label_num, in the order of bbox_from_rlsa
+    '''
+    pad = max(int(rlsa_thresh_h), 0) + max(int(rlsa_thresh_v), 0) + 1
+    region_label, regions = text_regions(mask_classes, label_nums, -(-pad // scale))
+    if not regions:  # no pixel of label_nums, nothing to do on the image
+        return [BoxSet() for _ in label_nums]
+
+    region_bboxs = scale_bboxs(np.reshape([bbox for _, bbox in regions], (-1, 4)),
+                               scale, img.shape)
+    # Otsu over the full page, the threshold is the one of bbox_from_rlsa.
+    page_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    (thresh, _) = cv2.threshold(page_gray, 150, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    crops = [(k, bbox, page_gray[bbox[0]:bbox[2], bbox[1]:bbox[3]])
+             for (k, _), bbox in zip(regions, region_bboxs)]
+
+    width = img.shape[1]
+    boxes = [BoxSet() for _ in label_nums]
+    starts = [[] for _ in label_nums]  # first pixel of each box, gives the label order
+    for k, (r0, c0, r1, c1), gray in crops:
+        (_, image_binary) = cv2.threshold(gray, thresh, 255, cv2.THRESH_BINARY)
+        img_rlsa = rlsa_fast(image_binary, True, False, rlsa_thresh_h, executor)
+        img_rlsa = rlsa_fast(img_rlsa, False, True, rlsa_thresh_v, executor)
+
+        in_region = upsample_box(region_label, (r0, c0, r1, c1), scale) == k
+        classes = upsample_box(mask_classes, (r0, c0, r1, c1), scale)
+        for i, label_num in enumerate(label_nums):
+            mask_class = in_region & (classes == label_num)
+            img_rlsa_res = 255 - rlsa_res_by_mask(img_rlsa, mask_class)
+            for r in measure.regionprops(measure.label(img_rlsa_res, connectivity=1)):
+                boxes[i].append(np.add(r['bbox'], (r0, c0, r0, c0)), label_num)
+                starts[i].append((r0 + r.coords[0][0]) * width + c0 + r.coords[0][1])
+
+    return [b.select(np.argsort(np.int64(start), kind='stable'))
+            for b, start in zip(boxes, starts)]
+
+
+def set_confs(boxes, mask, c, scale=1):
+    ''' Confs of boxes: mean score of channel c inside each box '''
+    confs = boxes.confs
+    for i, bbox in enumerate(boxes.bboxs):
+        confs[i] = box_mean(mask, bbox, c, scale) / 255.0
+    return boxes
 
 
 # 针对图片表格，直接用热图
-def bbox_from_mask(mask, c):
+def bbox_from_mask(mask, c, mask_classes=None, scale=1, page_shape=None):
     '''
     c: label {2-table, 3-figure}
+    mask_classes: argmax of mask, pass it in to share it between calls
+    scale: page pixels per mask cell, the labeling runs on the cells (see lowres.py)
+    page_shape: (height, width) of the page, default the mask shape times scale
+    return: BoxSet of label c, in page pixels
     '''
-    height, width, num_classes = mask.shape
-    mask_classes = np.argmax(mask, axis=2)
+    if mask_classes is None:
+        mask_classes = np.argmax(mask, axis=2)
+    if page_shape is None:
+        page_shape = (mask.shape[0] * scale, mask.shape[1] * scale)
 
     mask_class = np.int32(mask_classes == c)
     mask_label = measure.label(mask_class, connectivity=1)
     props = measure.regionprops(mask_label)
 
-    bboxs_class = [prop['bbox'] for prop in props]
-    bboxs_class = np.reshape(bboxs_class, (-1, 4))
-
-    labels = c * np.ones(len(bboxs_class))
-
-    confs_class = []
-    for idx in range(len(bboxs_class)):
-        bbox = bboxs_class[idx, :]
-        conf = np.mean(mask[bbox[0]:bbox[2], bbox[1]:bbox[3], c]) / 255.0
-        confs_class.append(conf)
-
-    # Format
-    bboxs_class = np.int32(bboxs_class)
-    labels = np.int32(labels)
-    return bboxs_class, labels, confs_class
+    bboxs = np.reshape([prop['bbox'] for prop in props], (-1, 4))
+    boxes = BoxSet.from_arrays(scale_bboxs(bboxs, scale, page_shape), c)
+    return set_confs(boxes, mask, c, scale)
 
 
 def draw_bbox(img, bboxs, labels):
@@ -163,130 +297,411 @@ def MergeTextBBox_col(boxes, value1=15, value2=8):  # 横向合并
     N = len(boxes)
     if N <= 1:
         return boxes
-    i = 1
-    out_boxes = []
-    A = boxes[0]
+    bboxs = boxes.bboxs
+    out_boxes = BoxSet(N)
+    A = bboxs[0].copy()
     for i in range(1, N):
-        B = boxes[i]
+        B = bboxs[i]
         if (abs(A[0] - B[0]) < value2 and abs(A[2] - B[2]) < value2 and
                 min(abs(B[1] - A[3]), abs(A[1] - B[3])) < value1 + 3):
-            AmergeB = [min(A[0], B[0]), min(A[1], B[1]),
-                       max(A[2], B[2]), max(A[3], B[3])]
-            # AmergeB = [A[0], A[1], B[2], B[3]]
-            A = AmergeB
-            # print("i = ", i)
-            # print("merge:", AmergeB)
+            A[0:2] = np.minimum(A[0:2], B[0:2])
+            A[2:4] = np.maximum(A[2:4], B[2:4])
         else:  # 没有合并
-            out_boxes.append(A)
-            A = B
-    out_boxes.append(A)  # 处理边界条件 i= N-1，加上最后一个
-    # out_boxes = np.array(out_boxes)
+            out_boxes.append(A, boxes.labels[i - 1])
+            A = B.copy()
+    out_boxes.append(A, boxes.labels[N - 1])  # 处理边界条件 i= N-1，加上最后一个
     return out_boxes
 
 
-def PreForRowMerge(boxes):  # 先按col大致分set，再set内排序
+def PreForRowMerge(boxes, thresh=50):  # 先按col大致分set，再set内排序
     '''
-    boxes dtype: list
+    Sort by x0, cut into sets where x0 jumps by thresh or more, sort each set
+    but the last one by y0.
     '''
-    boxes = sorted(boxes, key=lambda x: x[1])
-    N = len(boxes)
-    if N <= 1:
+    if len(boxes) <= 1:
         return boxes
-    tmp = []
-    thresh = 50
-    out_boxes = []
-    tmp.append(boxes[0])
-    for i in range(1, N):
-        A = boxes[i-1]
-        B = boxes[i]
-        if abs(B[1]-A[1]) < thresh:
-            tmp.append(B)
-        else:
-            tmp = sorted(tmp, key=lambda x: x[0])
-            out_boxes += tmp
-            tmp = [B]
-    out_boxes += tmp
-    return out_boxes
+    bboxs = boxes.bboxs
+    order = np.argsort(bboxs[:, 1], kind='stable')
+    x0 = bboxs[order, 1]
+    group = np.concatenate(([0], np.cumsum(np.abs(np.diff(x0)) >= thresh)))
+    y0 = bboxs[order, 0]
+    y0[group == group[-1]] = 0  # the last set was never sorted, keep it that way
+    order = order[np.lexsort((y0, group))]
+    return boxes.select(order)
 
 
 def MergeTextBBox_row(boxes, value1=15, value2=8):  # 纵向合并
     N = len(boxes)
     if N <= 1:
         return boxes
-    i = 1
-    out_boxes = []
-    A = boxes[0]
+    bboxs = boxes.bboxs
+    out_boxes = BoxSet(N)
+    A = bboxs[0].copy()
     for i in range(1, N):
-        B = boxes[i]
+        B = bboxs[i]
         if (abs(B[1] - A[1]) < value1 + 3 and abs(B[3] - A[3]) < value1 and
                 min(abs(B[0] - A[2]), abs(A[0] - B[2])) < 2 * value1):
-            AmergeB = [min(A[0], B[0]), min(A[1], B[1]),
-                       max(A[2], B[2]), max(A[3], B[3])]
-            # AmergeB = [A[0], A[1], B[2], B[3]]
-            A = AmergeB
-            # print("i = ", i)
-            # print("merge:", AmergeB)
+            A[0:2] = np.minimum(A[0:2], B[0:2])
+            A[2:4] = np.maximum(A[2:4], B[2:4])
         else:  # 没有合并
-            out_boxes.append(A)
-            A = B
-    out_boxes.append(A)  # 处理边界条件 i= N-1，加上最后一个
-    out_boxes = np.array(out_boxes)
+            out_boxes.append(A, boxes.labels[i - 1])
+            A = B.copy()
+    out_boxes.append(A, boxes.labels[N - 1])  # 处理边界条件 i= N-1，加上最后一个
     return out_boxes
 
 
-def process_one(img, mask, ifshow=False):
-    value1 = 15
-    value2 = 8
+def merge_text_boxes(text_rlsa_boxes, value1=15, value2=8, thresh=50):
+    ''' 横向合并 -> 按col分set -> 纵向合并 '''
+    merge_boxes = MergeTextBBox_col(text_rlsa_boxes, value1, value2)  # 横向合并
+    merge_boxes = PreForRowMerge(merge_boxes, thresh)
+    return MergeTextBBox_row(merge_boxes, value1, value2)
+
+
+def ink_integral(ink):
+    ''' Prefix sums S of a 2-d ink map, S[i, j] is the ink of ink[:i, :j] '''
+    S = np.zeros((ink.shape[0] + 1, ink.shape[1] + 1), np.int32)
+    np.cumsum(np.cumsum(ink, axis=0, dtype=np.int32), axis=1, out=S[1:, 1:])
+    return S
+
+
+def ink_segments(profile, min_gap):
+    '''
+    Ink segments of a projection profile, split where at least min_gap
+    consecutive entries are empty; empty ends are trimmed.
+    return: starts, ends (exclusive)
+    '''
+    ink = np.flatnonzero(profile)
+    if len(ink) == 0:
+        return ink, ink
+    split = np.flatnonzero(np.diff(ink) > min_gap)
+    starts = np.concatenate((ink[:1], ink[split + 1]))
+    ends = np.concatenate((ink[split], ink[-1:])) + 1
+    return starts, ends
+
+
+def xy_cut(S, row_gap, col_gap):
+    '''
+    Recursive XY-cut of the ink summed in S (see ink_integral): a region is split
+    at empty row runs of at least row_gap, else at empty column runs of at least
+    col_gap, until neither is found. Profiles are read from S, O(h + w) per region.
+    return: list of leaf boxes (y0, x0, y1, x1), top to bottom, left to right
+    '''
+    boxes = []
+    stack = [(0, 0, S.shape[0] - 1, S.shape[1] - 1)]
+    while stack:
+        y0, x0, y1, x1 = stack.pop()
+
+        rows = np.diff(S[y0:y1 + 1, x1] - S[y0:y1 + 1, x0])
+        starts, ends = ink_segments(rows, row_gap)
+        if len(starts) == 0:
+            continue
+        if len(starts) > 1:
+            stack.extend((y0 + a, x0, y0 + b, x1) for a, b in zip(starts[::-1], ends[::-1]))
+            continue
+        y0, y1 = y0 + starts[0], y0 + ends[0]
+
+        cols = np.diff(S[y1, x0:x1 + 1] - S[y0, x0:x1 + 1])
+        starts, ends = ink_segments(cols, col_gap)
+        if len(starts) > 1:
+            stack.extend((y0, x0 + a, y1, x0 + b) for a, b in zip(starts[::-1], ends[::-1]))
+            continue
+        boxes.append((y0, x0 + starts[0], y1, x0 + ends[0]))
+    return boxes
+
+
+def bbox_from_xycut(img, mask_classes, label_nums, row_gap, col_gap, scale=1):
+    '''
+    Text blocks by recursive XY-cut instead of rlsa, labeling and merges.
+    The page is binarized as for the rlsa, the ink of each of label_nums is
+    kept where the mask has that class.
+    scale: page pixels per mask cell (see lowres.py)
+    return: list of BoxSet, one per label_num, confs not set
+    '''
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    (thresh, image_binary) = cv2.threshold(
+    (_, image_binary) = cv2.threshold(
         gray, 150, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-    rlsa_thresh_h, rlsa_thresh_v = 15, 8
-    img_rlsa = rlsa(image_binary, True, False, rlsa_thresh_h)
-    img_rlsa = rlsa(img_rlsa, False, True, rlsa_thresh_v)
-
-    text_rlsa_boxes = bbox_from_rlsa(img_rlsa, mask, 1)
-    text_rlsa_boxes_ = text_rlsa_boxes.tolist()
-    merge_boxes = MergeTextBBox_col(text_rlsa_boxes_, value1, value2)  # 横向合并
-    merge_boxes = sorted(merge_boxes, key=lambda x: x[1])
-    merge_boxes = PreForRowMerge(merge_boxes)
-    text_rlsa_boxes = MergeTextBBox_row(merge_boxes, value1, value2)
-    text_labels = np.int32([1] * len(text_rlsa_boxes))
-    # print('bboxes number of text : %d' % len(text_rlsa_boxes))
-    table_boxes, table_labels, table_confs = bbox_from_mask(mask, 2)
-    # print('bboxes number of table : %d' % len(table_boxes))
-    figure_boxes, figure_labels, figure_confs = bbox_from_mask(mask, 3)
-    # print('bboxes number of figure : %d' % len(figure_boxes))
-    formula_rlsa_boxes = bbox_from_rlsa(img_rlsa, mask, 4)
-    formula_labels = np.int32([4] * len(formula_rlsa_boxes))
-    # print('bboxes number of formula : %d' % len(formula_rlsa_boxes))
+    ink = image_binary == 0
+
+    results = []
+    for label_num in label_nums:
+        S = ink_integral(ink & upsample_box(mask_classes == label_num,
+                                            (0, 0) + ink.shape, scale))
+        boxes = xy_cut(S, row_gap, col_gap)
+        results.append(BoxSet.from_arrays(np.reshape(boxes, (-1, 4)), label_num))
+    return results
+
+
+def layout_one(img, mask, rlsa_thresh_h=15, rlsa_thresh_v=8,
+               value1=15, value2=8, thresh=50, profiler=None, roi=True, executor=None,
+               deadline=None, engine='rlsa', mask_scale=1):
+    '''
+    Boxes of the 4 classes of one page.
+    profiler: optional, e.g. profiling.MemoryProfiler, its stage(name) wraps each stage
+    roi: only run the rlsa inside the text / formula regions of the mask
+    executor: optional thread pool, table / figure run concurrently with the rlsa,
+              which is split into bands; same result as the serial run
+    deadline: optional deadline.Deadline, once it is spent text and formula
+              boxes are taken from the mask, as for tables and figures
+    engine: 'rlsa', or 'xycut' to take the lines from bbox_from_xycut instead of
+            the rlsa, labeling and col merge; the cuts are at the gaps these do
+            not bridge, rlsa_thresh_v rows or max(rlsa_thresh_h, value1 + 3)
+            columns, then lines go through the row merge as usual.
+            Faster on clean column layouts.
+    mask_scale: page pixels per mask cell, for masks saved at the stride of the
+                network; argmax and labeling run on the cells (see lowres.py),
+                ValueError when the mask does not fit
+    return: boxes (N, 4) int32 y0, x0, y1, x1; labels (N,) int32 1-4; confs (N,) float32
+    '''
+    if engine not in ('rlsa', 'xycut'):
+        raise ValueError('unknown text engine %s' % engine)
+    check_scale(img.shape, mask.shape, mask_scale)
+
+    with stage(profiler, 'argmax'):
+        mask_classes = np.argmax(mask, axis=2)
+    page_shape = img.shape[:2]
+
+    if executor is not None:
+        table_future = executor.submit(bbox_from_mask, mask, 2, mask_classes,
+                                       mask_scale, page_shape)
+        figure_future = executor.submit(bbox_from_mask, mask, 3, mask_classes,
+                                        mask_scale, page_shape)
+
+    if expired(deadline, engine):
+        with stage(profiler, 'mask_boxes'):
+            text_boxes = bbox_from_mask(mask, 1, mask_classes, mask_scale, page_shape)
+            formula_boxes = bbox_from_mask(mask, 4, mask_classes, mask_scale, page_shape)
+    elif engine == 'xycut':
+        with stage(profiler, 'xycut'):
+            text_boxes, formula_boxes = bbox_from_xycut(
+                img, mask_classes, (1, 4), rlsa_thresh_v,
+                max(rlsa_thresh_h, value1 + 3), mask_scale)
+        with stage(profiler, 'text'):
+            text_boxes = MergeTextBBox_row(PreForRowMerge(text_boxes, thresh), value1, value2)
+            set_confs(text_boxes, mask, 1, mask_scale)
+        with stage(profiler, 'formula'):
+            set_confs(formula_boxes, mask, 4, mask_scale)
+    else:
+        with stage(profiler, 'rlsa'):
+            if roi:
+                text_boxes, formula_boxes = bbox_from_rlsa_roi(
+                    img, mask_classes, (1, 4), rlsa_thresh_h, rlsa_thresh_v,
+                    executor, mask_scale)
+            else:
+                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                (_, image_binary) = cv2.threshold(
+                    gray, 150, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+                img_rlsa = rlsa_fast(image_binary, True, False, rlsa_thresh_h, executor)
+                img_rlsa = rlsa_fast(img_rlsa, False, True, rlsa_thresh_v, executor)
+                text_boxes = bbox_from_rlsa(img_rlsa, mask, 1, mask_classes, mask_scale)
+                formula_boxes = bbox_from_rlsa(img_rlsa, mask, 4, mask_classes, mask_scale)
+
+        with stage(profiler, 'text'):
+            if expired(deadline, 'text'):
+                text_boxes = bbox_from_mask(mask, 1, mask_classes, mask_scale, page_shape)
+            else:
+                text_boxes = merge_text_boxes(text_boxes, value1, value2, thresh)
+                set_confs(text_boxes, mask, 1, mask_scale)
+        with stage(profiler, 'formula'):
+            set_confs(formula_boxes, mask, 4, mask_scale)
+
+    with stage(profiler, 'table'):
+        table_boxes = table_future.result() if executor is not None \
+            else bbox_from_mask(mask, 2, mask_classes, mask_scale, page_shape)
+    with stage(profiler, 'figure'):
+        figure_boxes = figure_future.result() if executor is not None \
+            else bbox_from_mask(mask, 3, mask_classes, mask_scale, page_shape)
 
     # 上面4类分开写是因为，不同类的处理方可能不同，先留有余地
-    # print(text_rlsa_boxes.shape)
-    # print(table_boxes.shape)
-    # print(figure_boxes.shape)
-    # print(formula_rlsa_boxes.shape)
-
-    boxes = np.concatenate((text_rlsa_boxes, table_boxes,
-                            figure_boxes, formula_rlsa_boxes), axis=0)
-    labels = np.concatenate(
-        (text_labels, table_labels, figure_labels, formula_labels), axis=0)
-    # print(boxes.shape)
-    # print(labels.shape)
-
-    process_one_img = draw_bbox(img, boxes, labels)
+    boxes = BoxSet.concatenate((text_boxes, table_boxes, figure_boxes, formula_boxes))
+    return boxes.arrays()
+
+
+def process_one(img, mask, ifshow=False, profiler=None, **kwargs):
+    '''
+    kwargs: parameters of layout_one
+    return: img with the boxes drawn
+    '''
+    boxes, labels, _ = layout_one(img, mask, profiler=profiler, **kwargs)
+
+    with stage(profiler, 'draw_bbox'):
+        process_one_img = draw_bbox(img, boxes, labels)
     if ifshow:
         Image.fromarray(process_one_img).show()
     return process_one_img
 
 
+def mask_from_png(png_path):
+    ''' HxWx5 mask, 255 on the channel of the class of each pixel '''
+
+    pred = np.array(Image.open(png_path).convert('RGB'))
+    mask = np.zeros(pred.shape[:2] + (len(PALETTE),), np.uint8)
+    for c, color in enumerate(PALETTE):
+        mask[..., c] = np.all(pred == color, axis=2) * 255
+    return mask
+
+
+def load_mask(source):
+    ''' Mask from a .npy file, or from a colored prediction .png '''
+
+    if isinstance(source, (str, os.PathLike)) and str(source).endswith('.png'):
+        return mask_from_png(source)
+    return np.load(source)
+
+
+def page_sources(img_dir):
+    '''
+    (name, image path, mask path) of the pages of img_dir: name.jpg with its
+    mask name.npy, else with its colored prediction name.png
+    raise: ValueError when there is no such page
+    '''
+    files = set(os.listdir(img_dir))
+    pages = []
+    for name in sorted(f[:-len('.jpg')] for f in files if f.endswith('.jpg')):
+        for mask_file in (name + '.npy', name + '.png'):
+            if mask_file in files:
+                pages.append((name, os.path.join(img_dir, name + '.jpg'),
+                              os.path.join(img_dir, mask_file)))
+                break
+    if not pages:
+        raise ValueError('no page in %s, expected name.jpg with name.npy or name.png'
+                         % img_dir)
+    return pages
+
+
+def load_source(source, loader):
+    ''' source: array, path or file-like object '''
+    if isinstance(source, np.ndarray):
+        return source
+    return loader(source)
+
+
+def source_name(source, index):
+    ''' Page name from a path or an opened file, else the position in the stream '''
+    path = source if isinstance(source, (str, os.PathLike)) else getattr(source, 'name', None)
+    if isinstance(path, (str, os.PathLike)):
+        return os.path.splitext(os.path.basename(path))[0]
+    return str(index)
+
+
+def layout_source(index, img_source, mask_source, kwargs, capture=None, page_budget=None):
+    '''
+    Load one (image, mask) pair and lay it out
+    capture: optional profiling.SlowPageCapture, only its budget is used, the
+             page timings are returned under 'timing' for the caller to add
+    page_budget: optional seconds for the page, the stages which fell back to
+                 cheaper boxes are then returned under 'degraded'
+    '''
+    name = source_name(img_source, index)
+    deadline = Deadline(page_budget) if page_budget else None
+    timing = None
+    if capture is not None:
+        timing = capture.start_page(name, index=index,
+                                    img=img_source if isinstance(img_source, str) else None,
+                                    mask=mask_source if isinstance(mask_source, str) else None)
+
+    with stage(timing, 'load'):
+        img = load_source(img_source, lambda f: np.array(Image.open(f).convert('RGB')))
+        mask = load_source(mask_source, load_mask)
+    boxes, labels, confs = layout_one(img, mask, profiler=timing, deadline=deadline, **kwargs)
+    page = {'index': index, 'name': name,
+            'boxes': boxes, 'labels': labels, 'confs': confs}
+    if deadline is not None:
+        page['degraded'] = deadline.degraded
+
+    if timing is not None:
+        # The profiled run gets the same budget, so it takes the same path.
+        page['timing'] = timing.end(lambda: layout_one(
+            img, mask, deadline=Deadline(page_budget) if page_budget else None, **kwargs))
+    return page
+
+
+def iter_layouts(pairs, executor=None, window=4, capture=None, page_budget=None, **kwargs):
+    '''
+    Lay out a stream of pages, lazily.
+    pairs: iterable of (image, mask), each an array, a path or a file-like object
+    executor: optional concurrent.futures executor, at most window pages are
+              submitted ahead, results still come in input order
+    capture: optional profiling.SlowPageCapture, slow pages are profiled where
+             they run and every page timing is added to capture
+    page_budget: optional seconds per page, see layout_one(deadline)
+    kwargs: parameters of layout_one
+    yield: {'index', 'name', 'boxes', 'labels', 'confs'} per page, 'timing'
+           with a capture and 'degraded' with a page budget
+    '''
+    # Pages only need the budget, the timings are added here once per page.
+    page_capture = capture.without_pages() if capture is not None else None
+
+    def added(page):
+        if capture is not None:
+            capture.add_page(page['timing'])
+        return page
+
+    if executor is None:
+        for index, (img_source, mask_source) in enumerate(pairs):
+            yield added(layout_source(index, img_source, mask_source, kwargs,
+                                      page_capture, page_budget))
+        return
+
+    pending = deque()
+    for index, (img_source, mask_source) in enumerate(pairs):
+        pending.append(executor.submit(layout_source, index, img_source,
+                                       mask_source, kwargs, page_capture, page_budget))
+        if len(pending) >= window:
+            yield added(pending.popleft().result())
+    while pending:
+        yield added(pending.popleft().result())
+
+
 def main():
-    img_path = "E:/project/jupyter/rlsa/img/1610QB02583_page42.jpg"
-    mask_path = "E:/project/jupyter/rlsa/img/1610QB02583_page42.npy"
-    mask = np.load(mask_path)
-    img = io.imread(img_path)  # cv2.imread 也可以
-    save_path = r'E:\project\table\rlsa\1.jpg'
-    one = process_one(img, mask, ifshow=True)
-    # plt.imsave(save_path, one)
+    parser = argparse.ArgumentParser(
+        description='Layout of the pages in img_dir '
+                    '(name.jpg with its mask name.npy or colored prediction name.png)')
+    parser.add_argument('img_dir', nargs='?', default='../img/')
+    parser.add_argument('--output', default='layouts.jsonl',
+                        help='json lines, one page per line')
+    parser.add_argument('--vis-dir', help='also save the images with boxes drawn')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes, 0 to run in this process')
+    parser.add_argument('--no-roi', action='store_true',
+                        help='run the rlsa on the full page')
+    parser.add_argument('--engine', choices=['rlsa', 'xycut'], default='rlsa',
+                        help='text block engine')
+    parser.add_argument('--mask-scale', type=int, default=1,
+                        help='page pixels per mask cell, for masks at the network stride')
+    parser.add_argument('--slow-budget', type=float,
+                        help='seconds per page, slower pages are profiled into --slow-dir')
+    parser.add_argument('--slow-dir', default='slow_pages')
+    parser.add_argument('--page-budget', type=float,
+                        help='seconds per page, slower pages fall back to mask boxes')
+    args = parser.parse_args()
+
+    try:
+        pages = page_sources(args.img_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    pairs = ((img_path, mask_path) for _, img_path, mask_path in pages)
+
+    executor = ProcessPoolExecutor(args.workers) if args.workers > 0 else None
+    capture = SlowPageCapture(args.slow_budget, args.slow_dir) if args.slow_budget else None
+    writer = JsonlWriter(args.output)
+    try:
+        for page in iter_layouts(pairs, executor, capture=capture,
+                                 page_budget=args.page_budget, roi=not args.no_roi,
+                                 engine=args.engine, mask_scale=args.mask_scale):
+            writer.add(page['name'], page['boxes'], page['labels'], page['confs'],
+                       page.get('degraded'))
+            if args.vis_dir:
+                img = io.imread(os.path.join(args.img_dir, page['name'] + '.jpg'))
+                plt.imsave(os.path.join(args.vis_dir, page['name'] + '.jpg'),
+                           draw_bbox(img, page['boxes'], page['labels']))
+    finally:
+        writer.close()
+        if executor:
+            executor.shutdown()
+        if capture:
+            capture.save()
+            print(capture.summary())
+
 
 if __name__ == "__main__":
     main()
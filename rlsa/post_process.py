@@ -6,10 +6,17 @@ import xml.dom.minidom
 
 import numpy as np
 from tqdm import tqdm
+from scipy import ndimage
 from skimage import io, measure, color, filters
 from PIL import Image, ImageDraw, ImageFont
 from matplotlib import pyplot as plt
 
+from boxset import BoxSet
+from deadline import Deadline, expired
+from lowres import box_mean, check_scale, scale_bboxs
+from profiling import MemoryProfiler, SlowPageCapture, stage
+from results import JsonlWriter, ResultSet, ResultWriter
+
 
 COLOR_LIST = [(255, 0, 0), (0, 0, 255), (0, 255, 0)]
 CLASSES_LIST = ['figureRegion', 'tableRegion', 'formulaRegion']
@@ -18,61 +25,60 @@ FONT = ImageFont.truetype(
     '/usr/share/fonts/truetype/freefont/FreeMonoBold.ttf', 20)
 
 
-def cut_from_masks(mask, small_object_thresh=100, expand_thresh=0.03):
-    ''' Cut image regions from the mask generated by FCN '''
+def label_bboxs(mask_class):
+    ''' Boxes of the 4-connected regions of a binary mask, in label order '''
+
+    mask_label = measure.label(mask_class, connectivity=1)
+    # find_objects gives the same boxes as regionprops without building an
+    # object per region, a noisy mask can have 100k regions.
+    return np.reshape([(rows.start, cols.start, rows.stop, cols.stop)
+                       for rows, cols in ndimage.find_objects(mask_label)], (-1, 4))
+
 
-    height, width, num_classes = mask.shape
+def cut_from_masks(mask, small_object_thresh=100, expand_thresh=0.03, scale=1, page_shape=None,
+                   deadline=None):
+    '''
+    Cut image regions from the mask generated by FCN
+    scale: page pixels per mask cell (see lowres.py), boxes are in page pixels
+    page_shape: (height, width) of the page, default the mask shape times scale
+    deadline: optional deadline.Deadline, once it is spent the conf of a box is
+              the mask at its center instead of its mean
+    '''
+
+    height, width = page_shape[:2] if page_shape is not None else \
+        (mask.shape[0] * scale, mask.shape[1] * scale)
     mask_classes = np.argmax(mask, axis=2)
 
-    bboxs = []
-    labels = []
-    confs = []
+    class_boxes = []
 
     # Figures=1, Tables=2, Equations=3.
     for c in range(1, 4):
 
-        mask_class = np.int32(mask_classes == c)
-        mask_label = measure.label(mask_class, connectivity=1)
-        props = measure.regionprops(mask_label)
-
-        bboxs_class = [prop['bbox'] for prop in props]
-        bboxs_class = np.reshape(bboxs_class, (-1, 4))
-        bboxs.append(bboxs_class)
-        labels.append(c * np.ones(len(bboxs_class)))
-
-        confs_class = []
-        for idx in range(len(bboxs_class)):
-            bbox = bboxs_class[idx, :]
-            conf = np.mean(mask[bbox[0]:bbox[2], bbox[1]:bbox[3], c])
-            confs_class.append(conf)
-        confs.append(confs_class)
-
-    # Concatenate
-    bboxs = np.concatenate((bboxs[0], bboxs[1], bboxs[2]), axis=0)
-    labels = np.concatenate((labels[0], labels[1], labels[2]), axis=0)
-    confs = np.concatenate((confs[0], confs[1], confs[2]))
-
-    # Eliminate small regions.
-    area = (bboxs[:, 2] - bboxs[:, 0]) * (bboxs[:, 3] - bboxs[:, 1])
-    bboxs = bboxs[area > small_object_thresh, :]
-    labels = labels[area > small_object_thresh]
-    confs = confs[area > small_object_thresh]
+        bboxs = scale_bboxs(label_bboxs(mask_classes == c), scale, (height, width))
+
+        # Eliminate small regions, before their confs are computed.
+        boxes = BoxSet.from_arrays(bboxs, c).filter_size(min_area=small_object_thresh)
+        confs = boxes.confs
+        for i, bbox in enumerate(boxes.bboxs):
+            if expired(deadline, 'cut_from_masks'):
+                confs[i] = mask[min((bbox[0] + bbox[2]) // 2 // scale, mask.shape[0] - 1),
+                                min((bbox[1] + bbox[3]) // 2 // scale, mask.shape[1] - 1), c]
+            else:
+                confs[i] = box_mean(mask, bbox, c, scale)
+        class_boxes.append(boxes)
+
+    boxes = BoxSet.concatenate(class_boxes)
 
     # Expand for a small thresh
-    height_rec = bboxs[:, 2] - bboxs[:, 0]
-    width_rec = bboxs[:, 3] - bboxs[:, 1]
-    expand = np.int64(np.minimum(width_rec, height_rec) * expand_thresh)
+    bboxs = boxes.bboxs
+    expand = np.int64(np.minimum(boxes.widths(), boxes.heights()) * expand_thresh)
 
     bboxs[:, 0] = np.maximum(0, bboxs[:, 0] - expand)
     bboxs[:, 1] = np.maximum(0, bboxs[:, 1] - expand)
     bboxs[:, 2] = np.minimum(height, bboxs[:, 2] + expand)
     bboxs[:, 3] = np.minimum(width, bboxs[:, 3] + expand)
 
-    # Format
-    bboxs = np.int32(bboxs)
-    labels = np.int32(labels)
-
-    return bboxs, labels, confs
+    return boxes
 
 
 def modify_boundary(img_bw):
@@ -138,19 +144,17 @@ def rlsa(img_bw, hor=True):
     return img_rlsa
 
 
-def figure_process(img, mask, bboxs, lables, confs):
+def figure_process(img, mask, boxes, deadline=None, scale=1):
     '''figure cut and white boundary remove '''
 
-    bboxs_new = np.reshape([], (-1, 4))
-    labels_new = np.reshape([], (-1, ))
-    confs_new = np.reshape([], (-1, ))
+    boxes_new = BoxSet()
 
-    for i in range(len(bboxs)):
+    for i, (x1, y1, x2, y2) in enumerate(boxes.bboxs):
 
-        x1 = bboxs[i, 0]
-        y1 = bboxs[i, 1]
-        x2 = bboxs[i, 2]
-        y2 = bboxs[i, 3]
+        # Out of time, keep the remaining boxes of the mask as they are
+        if expired(deadline, 'figure_process'):
+            boxes_new.extend(boxes.bboxs[i:], 1, boxes.confs[i:])
+            break
 
         image = img[x1:x2, y1:y2]
         image_bw = image > 0.9  # Binarization
@@ -183,44 +187,29 @@ def figure_process(img, mask, bboxs, lables, confs):
             idx_end = [idx_end[-1]]
 
         # For each cut, update bboxs, labels and confs
+        boxes_new.reserve(len(idx_start))
         for start, end in zip(idx_start, idx_end):
-            bbox_new = np.reshape([x1 + modify_idx[0], y1 + start,
-                                   x1 + modify_idx[2] - 1, y1 + end - 1], (1, 4))
-            conf_new = np.mean(mask[bbox_new[0, 0]:bbox_new[0, 2] + 1,
-                                    bbox_new[0, 1]:bbox_new[0, 3] + 1, 1])
-            bboxs_new = np.concatenate((bboxs_new, bbox_new))
-            labels_new = np.append(labels_new, 1)
-            confs_new = np.append(confs_new, conf_new)
-
-    bboxs_new = np.int32(bboxs_new)
-    labels_new = np.int32(labels_new)
-
-    height = bboxs_new[:, 2] - bboxs_new[:, 0]
-    width = bboxs_new[:, 3] - bboxs_new[:, 1]
-    area = width * height
-    # remain_list = np.logical_and(width > 10, height > 0, area > 0)
-    remain_list = np.logical_and(width > 0, height > 0, area > 0)
-
-    bboxs_new = bboxs_new[remain_list, :]
-    labels_new = labels_new[remain_list]
-    confs_new = confs_new[remain_list]
+            bbox_new = [x1 + modify_idx[0], y1 + start,
+                        x1 + modify_idx[2] - 1, y1 + end - 1]
+            conf_new = box_mean(mask, (bbox_new[0], bbox_new[1],
+                                       bbox_new[2] + 1, bbox_new[3] + 1), 1, scale)
+            boxes_new.append(bbox_new, 1, conf_new)
 
-    return bboxs_new, labels_new, confs_new
+    # remain_list = np.logical_and(width > 10, height > 0, area > 0)
+    return boxes_new.filter_size()
 
 
-def table_process(img, mask, bboxs, labels, confs):
+def table_process(img, mask, boxes, deadline=None, scale=1):
     ''' boundary remove '''
 
-    bboxs_new = np.reshape([], (-1, 4))
-    labels_new = np.reshape([], (-1, ))
-    confs_new = np.reshape([], (-1, ))
+    boxes_new = BoxSet(len(boxes))
 
-    for i in range(len(bboxs)):
+    for i, (x1, y1, x2, y2) in enumerate(boxes.bboxs):
 
-        x1 = bboxs[i, 0]
-        y1 = bboxs[i, 1]
-        x2 = bboxs[i, 2]
-        y2 = bboxs[i, 3]
+        # Out of time, keep the remaining boxes of the mask as they are
+        if expired(deadline, 'table_process'):
+            boxes_new.extend(boxes.bboxs[i:], 2, boxes.confs[i:])
+            break
 
         image = img[x1:x2, y1:y2]
         image = image > 0.9
@@ -231,44 +220,26 @@ def table_process(img, mask, bboxs, labels, confs):
         else:
             modify_idx = modify_boundary(image)
 
-        bbox_new = [[x1 + modify_idx[0], y1 + modify_idx[1],
-                     x1 + modify_idx[2], y1 + modify_idx[3]]]
-        conf_new = np.mean(mask[bbox_new[0][0]:bbox_new[0][2],
-                                bbox_new[0][1]:bbox_new[0][3], 2])
+        bbox_new = [x1 + modify_idx[0], y1 + modify_idx[1],
+                    x1 + modify_idx[2], y1 + modify_idx[3]]
+        conf_new = box_mean(mask, bbox_new, 2, scale)
+        boxes_new.append(bbox_new, 2, conf_new)
 
-        bboxs_new = np.concatenate((bboxs_new, bbox_new), axis=0)
-        labels_new = np.append(labels_new, 2)
-        confs_new = np.append(confs_new, conf_new)
-
-    bboxs_new = np.int32(bboxs_new)
-    labels_new = np.int32(labels_new)
-
-    width = bboxs_new[:, 2] - bboxs_new[:, 0]
-    height = bboxs_new[:, 3] - bboxs_new[:, 1]
-    area = width * height
     # remain_list = np.logical_and(width > 30, height > 30, area > 1000)
-    remain_list = np.logical_and(width > 0, height > 0, area > 0)
-
-    bboxs_new = bboxs_new[remain_list, :]
-    labels_new = labels_new[remain_list]
-    confs_new = confs_new[remain_list]
-
-    return bboxs_new, labels_new, confs_new
+    return boxes_new.filter_size()
 
 
-def equation_process(img, mask, bboxs, lables, confs):
+def equation_process(img, mask, boxes, deadline=None, scale=1):
     '''equation cut by rlsa'''
 
-    bboxs_new = np.reshape([], (-1, 4))
-    labels_new = np.reshape([], (-1, ))
-    confs_new = np.reshape([], (-1, ))
+    boxes_new = BoxSet()
 
-    for i in range(len(bboxs)):
+    for i, (x1, y1, x2, y2) in enumerate(boxes.bboxs):
 
-        x1 = bboxs[i, 0]
-        y1 = bboxs[i, 1]
-        x2 = bboxs[i, 2]
-        y2 = bboxs[i, 3]
+        # Out of time, keep the remaining boxes of the mask as they are
+        if expired(deadline, 'equation_process'):
+            boxes_new.extend(boxes.bboxs[i:], 3, boxes.confs[i:])
+            break
 
         image = img[x1:x2, y1:y2]
         image = image > 0.9
@@ -278,129 +249,93 @@ def equation_process(img, mask, bboxs, lables, confs):
         if np.min(image.shape) <= 1:
             continue
 
-        # Find new bboxs in rlsa result
+        # Find new bboxs in rlsa result, updata bboxs, labels and confs
         image_label = measure.label(1 - image)
         props = measure.regionprops(image_label)
-        bboxs_rlsa = [prop['bbox'] for prop in props]
-        bboxs_rlsa = np.array(bboxs_rlsa, np.int32)
 
-        if len(bboxs_rlsa) == 0:
-            continue
+        boxes_new.reserve(len(props))
+        for prop in props:
+            bbox_rlsa = np.add(prop['bbox'], (x1, y1, x1, y1))
+            conf_rlsa = box_mean(mask, bbox_rlsa, 3, scale)
+            boxes_new.append(bbox_rlsa, 3, conf_rlsa)
 
-        bboxs_rlsa[:, 0] += x1
-        bboxs_rlsa[:, 1] += y1
-        bboxs_rlsa[:, 2] += x1
-        bboxs_rlsa[:, 3] += y1
-
-        # Updata bboxs, labels and confs
-        for bbox_rlsa in bboxs_rlsa:
-            conf_rlsa = np.mean(mask[bbox_rlsa[0]:bbox_rlsa[2],
-                                     bbox_rlsa[1]:bbox_rlsa[3], 3])
-            bboxs_new = np.concatenate((bboxs_new, [bbox_rlsa]), axis=0)
-            labels_new = np.append(labels_new, 3)
-            confs_new = np.append(confs_new, conf_rlsa)
-
-    # print(bboxs_new)
-    bboxs_new = np.int32(bboxs_new)
-    labels_new = np.int32(labels_new)
-
-    height = bboxs_new[:, 2] - bboxs_new[:, 0]
-    width = bboxs_new[:, 3] - bboxs_new[:, 1]
-    area = width * height
     # remain_list = np.logical_and(width > 10, height > 0, area > 0)
-    remain_list = np.logical_and(width > 0, height > 0, area > 0)
+    return boxes_new.filter_size()
 
-    bboxs_new = bboxs_new[remain_list, :]
-    labels_new = labels_new[remain_list]
-    confs_new = confs_new[remain_list]
 
-    return bboxs_new, labels_new, confs_new
+def overlap_ratio(bboxs):
+    ''' overlap[i, j]: part of the area of box i covered by box j, 0 on the diagonal '''
 
+    areas = (bboxs[:, 2] - bboxs[:, 0]) * (bboxs[:, 3] - bboxs[:, 1])
 
-def bbox_overlap(bboxs, labels, confs, overlap_thresh=0.8, small_thresh=30):
+    overlap_width = np.minimum(bboxs[:, None, 2], bboxs[None, :, 2]) - \
+        np.maximum(bboxs[:, None, 0], bboxs[None, :, 0])
+    overlap_height = np.minimum(bboxs[:, None, 3], bboxs[None, :, 3]) - \
+        np.maximum(bboxs[:, None, 1], bboxs[None, :, 1])
+    overlap_area = np.maximum(overlap_height, 0) * np.maximum(overlap_width, 0)
 
-    areas = (bboxs[:, 2] - bboxs[:, 0]) * (bboxs[:, 3] - bboxs[:, 1])
+    overlap = overlap_area / np.float32(areas)[:, None]
+    np.fill_diagonal(overlap, 0)
+    return overlap
+
+
+def bbox_overlap(boxes, overlap_thresh=0.8, small_thresh=30):
 
     # Remove bboxs with area less than a small threshold
-    bboxs = bboxs[areas > small_thresh, :]
-    labels = labels[areas > small_thresh]
-    confs = confs[areas > small_thresh]
-    areas = areas[areas > small_thresh]
+    boxes = boxes.select(boxes.areas() > small_thresh)
 
     # if there is less than one bboxs then return.
-    if len(bboxs) <= 1:
-        return bboxs, labels, confs
-
-    areas = (bboxs[:, 2] - bboxs[:, 0]) * (bboxs[:, 3] - bboxs[:, 1])
-    overlap = np.zeros((bboxs.shape[0], bboxs.shape[0]))
+    if len(boxes) <= 1:
+        return boxes
 
     # Compute the overlap ratio by the given bounding boxes.
-    for i, (bbox1, label1) in enumerate(zip(bboxs, labels)):
-        for j, (bbox2, label2) in enumerate(zip(bboxs, labels)):
-            # Overlaps within the same class label are set to 0.
-            if label1 != label2 or i == j:
-                continue
-            overlap_width = np.min((bbox1[2], bbox2[2])) - \
-                np.max((bbox1[0], bbox2[0]))
-            overlap_height = np.min((bbox1[3], bbox2[3])) - \
-                np.max((bbox1[1], bbox2[1]))
-            overlap_area = np.max((overlap_height, 0)) * \
-                np.max((overlap_width, 0))
-            overlap[i, j] = overlap_area / np.float32(areas[i])
-
-    while True:
-        # Remove the duplicate bounding boxes by overlap ratio threshold.
-        idx = np.where(overlap > overlap_thresh)
-        if len(idx[0]) == 0:
-            break
+    # Overlaps within the same class label are set to 0.
+    labels = boxes.labels
+    overlap = overlap_ratio(boxes.bboxs)
+    overlap[labels[:, None] != labels[None, :]] = 0
 
-        # Update bounding box overlap matrix.
-        delete_idx = idx[0][0]
-        overlap = np.delete(overlap, delete_idx, axis=0)
-        overlap = np.delete(overlap, delete_idx, axis=1)
+    # Remove the duplicate bounding boxes by overlap ratio threshold, in
+    # index order: a box goes when a remaining box covers it.
+    keep = np.ones(len(boxes), bool)
+    for i in range(len(boxes)):
+        if np.any(overlap[i, keep] > overlap_thresh):
+            keep[i] = False
 
-        # Update bboxs, labels and confs.
-        bboxs = np.delete(bboxs, delete_idx, axis=0)
-        labels = np.delete(labels, delete_idx)
-        confs = np.delete(confs, delete_idx)
+    return boxes.select(keep)
 
-    return bboxs, labels, confs
 
+def bbox_overlap_simple(boxes, overlap_thresh=0.8, small_thresh=30):
+    '''
+    Cheaper bbox_overlap without the sequential removal: a box goes when a
+    larger box of the same class covers it
+    '''
 
-def bbox_overlap_back(bboxs, labels, confs, overlap_thresh=0.6, small_thresh=30):
-    ''' Compute overlap ratio matrix on given bboxes '''
+    boxes = boxes.select(boxes.areas() > small_thresh)
 
-    areas = (bboxs[:, 2] - bboxs[:, 0]) * (bboxs[:, 3] - bboxs[:, 1])
+    if len(boxes) <= 1:
+        return boxes
 
-    # Remove bboxs with area less than a small threshold
-    bboxs = bboxs[areas > small_thresh, :]
-    labels = labels[areas > small_thresh]
-    confs = confs[areas > small_thresh]
-    areas = areas[areas > small_thresh]
+    # Rank by area, ties by index, so two equal boxes keep the first one.
+    rank = np.empty(len(boxes), np.int64)
+    rank[np.argsort(-boxes.areas(), kind='stable')] = np.arange(len(boxes))
 
-    if len(bboxs) <= 1:
-        return bboxs, labels, confs
+    labels = boxes.labels
+    covered = (overlap_ratio(boxes.bboxs) > overlap_thresh) & \
+        (labels[:, None] == labels[None, :]) & (rank[:, None] > rank[None, :])
+    return boxes.select(~np.any(covered, axis=1))
 
-    overlap = np.zeros((bboxs.shape[0], bboxs.shape[0]))
 
-    for i in range(bboxs.shape[0]):
-        bbox1 = bboxs[i, :]
-        for j in range(bboxs.shape[0]):
-            if i != j:
-                bbox2 = bboxs[j, :]
-                overlap_width = np.min((bbox1[2], bbox2[2])) - \
-                    np.max((bbox1[0], bbox2[0]))
-                overlap_height = np.min((bbox1[3], bbox2[3])) - \
-                    np.max((bbox1[1], bbox2[1]))
-                overlap_area = np.max((overlap_height, 0)) * \
-                    np.max((overlap_width, 0))
-                overlap[i, j] = overlap_area / np.float32(areas[i])
-
-    bboxs = np.int32(bboxs[np.all(overlap < overlap_thresh, axis=1)])
-    labels = np.int32(labels[np.all(overlap < overlap_thresh, axis=1)])
-    confs = confs[np.all(overlap < overlap_thresh, axis=1)]
+def bbox_overlap_back(boxes, overlap_thresh=0.6, small_thresh=30):
+    ''' Compute overlap ratio matrix on given bboxes '''
 
-    return bboxs, labels, confs
+    # Remove bboxs with area less than a small threshold
+    boxes = boxes.select(boxes.areas() > small_thresh)
+
+    if len(boxes) <= 1:
+        return boxes
+
+    overlap = overlap_ratio(boxes.bboxs)
+    return boxes.select(np.all(overlap < overlap_thresh, axis=1))
 
 
 def write_xml(root, doc, name, bboxs, labels, confs):
@@ -488,47 +423,62 @@ def draw_bbox(img, bboxs, labels, confs, gt=None):
     return img_return
 
 
-def process_one(img, mask):
-    ''' process one image '''
-
-    bboxs, labels, confs = cut_from_masks(mask)
-
-    figure_idx = np.where(labels == 1)[0]
-    bboxs_figure = bboxs[figure_idx]
-    labels_figure = labels[figure_idx]
-    confs_figure = confs[figure_idx]
-    bboxs_figure, labels_figure, confs_figure = \
-        figure_process(img, mask, bboxs_figure, labels_figure, confs_figure)
-
-    table_idx = np.where(labels == 2)[0]
-    bboxs_table = bboxs[table_idx]
-    labels_table = labels[table_idx]
-    confs_table = confs[table_idx]
-    bboxs_table, labels_table, confs_table = \
-        table_process(img, mask, bboxs_table, labels_table, confs_table)
+def process_one(img, mask, profiler=None, executor=None, deadline=None, mask_scale=1):
+    '''
+    process one image
+    executor: optional thread pool, figure / table / equation are then processed
+              concurrently, with the same result as the serial run
+    deadline: optional deadline.Deadline, once it is spent the boxes of the mask
+              are kept without the cuts, with the conf at their center, and
+              bbox_overlap_simple is used
+    mask_scale: page pixels per mask cell, for masks saved at the stride of the
+                network (see lowres.py); ValueError when the mask does not fit
+    return: bboxs (N, 4) int32, labels (N,) int32, confs (N,) float32
+    '''
+
+    check_scale(img.shape, mask.shape, mask_scale)
+    with stage(profiler, 'cut_from_masks'):
+        boxes = cut_from_masks(mask, scale=mask_scale, page_shape=img.shape,
+                               deadline=deadline)
+
+    processes = [('figure_process', figure_process, 1),
+                 ('table_process', table_process, 2),
+                 ('equation_process', equation_process, 3)]
+
+    if executor is None:
+        results = []
+        for name, class_process, c in processes:
+            with stage(profiler, name):
+                results.append(class_process(
+                    img, mask, boxes.select(boxes.labels == c), deadline, mask_scale))
+    else:
+        with stage(profiler, 'class_process'):
+            futures = [executor.submit(class_process, img, mask,
+                                       boxes.select(boxes.labels == c), deadline, mask_scale)
+                       for _, class_process, c in processes]
+            results = [future.result() for future in futures]
+
+    with stage(profiler, 'bbox_overlap'):
+        if expired(deadline, 'bbox_overlap'):
+            boxes = bbox_overlap_simple(BoxSet.concatenate(results))
+        else:
+            boxes = bbox_overlap(BoxSet.concatenate(results))
+    return boxes.arrays()
 
-    equation_idx = np.where(labels == 3)[0]
-    bboxs_equation = bboxs[equation_idx]
-    labels_equation = labels[equation_idx]
-    confs_equation = confs[equation_idx]
-    bboxs_equation, labels_equation, confs_equation = \
-        equation_process(img, mask, bboxs_equation,
-                         labels_equation, confs_equation)
 
-    bboxs = np.concatenate((bboxs_figure, bboxs_table, bboxs_equation), axis=0)
-    labels = np.concatenate((labels_figure, labels_table, labels_equation))
-    confs = np.concatenate((confs_figure, confs_table, confs_equation))
+def load_page(img_path, mask_path):
+    ''' Read an image (raw and gray) and its mask. '''
 
-    bboxs, labels, confs = bbox_overlap(bboxs, labels, confs)
-    return bboxs, labels, confs
+    img_raw = io.imread(img_path)
+    img = color.rgb2gray(img_raw)
+    mask = np.load(mask_path)
+    return img_raw, img, mask
 
 
 def test_one(img_path, mask_path, vis=False, gt_path=None):
     ''' Test on one given pair of image and mask. '''
 
-    img_raw = io.imread(img_path)
-    img = color.rgb2gray(img_raw)
-    mask = np.load(mask_path)
+    img_raw, img, mask = load_page(img_path, mask_path)
 
     bboxs, labels, confs = process_one(img, mask)
 
@@ -540,31 +490,78 @@ def test_one(img_path, mask_path, vis=False, gt_path=None):
     return bboxs, labels, confs
 
 
-def test_all(img_dir, mask_dir, output_file='submission.xml', output_dir=None, gt_dir=None):
-    ''' Test on a set of images and save the predicion xml file '''
+def page_names(mask_dir):
+    ''' Names of the pages which have a prediction in mask_dir, sorted. '''
+
+    return sorted(mask.split('_pred.png')[0] for mask in os.listdir(mask_dir)
+                  if mask.endswith('.png'))
+
+
+def test_all(img_dir, mask_dir, output_file='submission.xml', output_dir=None, gt_dir=None,
+             mem_report=None, result_dir=None, jsonl_file=None,
+             slow_budget=None, slow_dir='slow_pages', page_budget=None, mask_scale=1):
+    '''
+    Test on a set of images and save the predicion xml file
+    mem_report: save the memory used by each stage of each page to this json file
+    result_dir: also save the results as columnar arrays (see results.py)
+    jsonl_file: also save the results as json lines, one page per line
+    slow_budget: seconds per page, pages over it are profiled into slow_dir
+                 (see profiling.SlowPageCapture)
+    page_budget: seconds per page, slower pages fall back to cheaper boxes
+                 (see process_one), they are listed at the end and flagged
+                 in jsonl_file
+    mask_scale: page pixels per mask cell, see process_one
+    '''
+
+    if mem_report and slow_budget:
+        raise ValueError('mem_report and slow_budget can not be used together, '
+                         'tracemalloc would dominate the page times')
+    if mem_report:
+        profiler = MemoryProfiler()
+    elif slow_budget:
+        profiler = SlowPageCapture(slow_budget, slow_dir)
+    else:
+        profiler = None
+
+    writers = []
+    if result_dir:
+        writers.append(ResultWriter(result_dir))
+    if jsonl_file:
+        writers.append(JsonlWriter(jsonl_file))
 
     doc = xml.dom.minidom.Document()
     root = doc.createElement('')
     doc.appendChild(root)
 
-    masks = os.listdir(mask_dir)
-    for mask in tqdm(masks):
-
-        if not mask.endswith('.png'):
-            continue
-
-        name = mask.split('_pred.png')[0]
-        # print name
+    degraded = {}
+    for name in tqdm(page_names(mask_dir)):
 
         img_path = img_dir + name + '.jpg'
-        img_raw = io.imread(img_path)
-        img = color.rgb2gray(img_raw)
-
         mask_path = mask_dir + name + '_prob.npy'
-        mask = np.load(mask_path)
-
-        bboxs, labels, confs = process_one(img, mask)
+        deadline = Deadline(page_budget) if page_budget else None
+        if mem_report:
+            profiler.start_page(name)
+            page_profiler = profiler
+        elif slow_budget:
+            page_profiler = profiler.start_page(name, img=img_path, mask=mask_path)
+        else:
+            page_profiler = None
+        with stage(page_profiler, 'load_page'):
+            img_raw, img, mask = load_page(img_path, mask_path)
+
+        bboxs, labels, confs = process_one(img, mask, page_profiler, deadline=deadline,
+                                           mask_scale=mask_scale)
+        if slow_budget:
+            # The profiled run gets the same budget, so it takes the same path.
+            profiler.add_page(page_profiler.end(lambda: process_one(
+                img, mask, deadline=Deadline(page_budget) if page_budget else None,
+                mask_scale=mask_scale)))
+        if deadline and deadline.degraded:
+            degraded[name] = deadline.degraded
         write_xml(root, doc, name, bboxs, labels, confs)
+        for writer in writers:
+            writer.add(name, bboxs, labels, confs,
+                       degraded=deadline.degraded if deadline else None)
 
         if output_dir:
             gt = open(gt_dir + name + '.txt', 'r').readlines()
@@ -574,6 +571,33 @@ def test_all(img_dir, mask_dir, output_file='submission.xml', output_dir=None, g
     with open(output_file, 'w') as xml_file:
         doc.writexml(xml_file, newl='\n', addindent='\t', encoding='UTF-8')
 
+    for writer in writers:
+        writer.close()
+
+    if mem_report:
+        profiler.save(mem_report)
+    elif slow_budget:
+        profiler.save()
+
+    if page_budget:
+        print('%d pages over the %gs budget were degraded' % (len(degraded), page_budget))
+        for name, stages in degraded.items():
+            print('    %s: %s' % (name, ', '.join(stages)))
+
+
+def results_to_xml(result_dir, output_file='submission.xml'):
+    ''' Generate the submission xml from a result directory '''
+
+    doc = xml.dom.minidom.Document()
+    root = doc.createElement('')
+    doc.appendChild(root)
+
+    for name, bboxs, labels, confs in ResultSet(result_dir):
+        write_xml(root, doc, name, bboxs, labels, confs)
+
+    with open(output_file, 'w') as xml_file:
+        doc.writexml(xml_file, newl='\n', addindent='\t', encoding='UTF-8')
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,278 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+'''
+Opt-in profiling of the pipeline stages.
+
+process_one(..., profiler=p) wraps each of its stages in p.stage(name), any
+object with such a context manager method can be passed.
+    MemoryProfiler      traced memory and largest arrays at the peak of each stage
+    SlowPageCapture     wall time per stage (PageTiming), cProfile dump of the
+                        slow pages
+'''
+
+
+def stage(profiler, name):
+    ''' profiler.stage(name), or nothing when there is no profiler '''
+
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
+
+
+# Allocations are reported at the last frame of the pipeline code, not in numpy.
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def pipeline_frame(traceback):
+    ''' The most recent frame under PIPELINE_DIR, else the most recent one '''
+
+    for frame in reversed(traceback):
+        if os.path.abspath(frame.filename).startswith(PIPELINE_DIR + os.sep):
+            return frame
+    return traceback[-1]
+
+
+def array_snapshot():
+    ''' tracemalloc snapshot of the numpy array allocations only '''
+
+    snapshot = tracemalloc.take_snapshot()
+    # Same as filter_traces([DomainFilter(True, domain)]), which matches each
+    # trace in Python and takes seconds on the deep tracebacks of a page.
+    domain = np.lib.tracemalloc_domain
+    return tracemalloc.Snapshot([trace for trace in snapshot.traces._traces
+                                 if trace[0] == domain], snapshot.traceback_limit)
+
+
+def largest_arrays(snapshot, before, top):
+    ''' The top array allocations of snapshot not in before, by pipeline line '''
+
+    sizes = {}
+    for stat in snapshot.compare_to(before, 'traceback'):
+        if stat.size_diff > 0:
+            where = str(pipeline_frame(stat.traceback))
+            size, count = sizes.get(where, (0, 0))
+            sizes[where] = (size + stat.size_diff, count + max(stat.count_diff, 0))
+    largest = sorted(sizes.items(), key=lambda item: item[1][0], reverse=True)
+    return [{'where': where, 'bytes': size, 'count': count}
+            for where, (size, count) in largest[:top]]
+
+
+class PeakSampler(object):
+    '''
+    The largest arrays alive when the traced memory is highest, polled from a
+    thread every interval seconds. A snapshot is only taken once the memory
+    grew by growth times since the last one, and by min_growth bytes or more.
+    Temporaries shorter than interval can be missed, sampled is the traced
+    memory at the snapshot kept. The peak is tracked around the snapshots, so
+    they do not count in it.
+    '''
+
+    def __init__(self, before, top, interval=0.001, growth=1.1, min_growth=1 << 20):
+
+        self.before = before
+        self.top = top
+        self.interval = interval
+        self.growth = growth
+        self.min_growth = min_growth
+        self.arrays = []
+        self.sampled = 0
+        self.peak = 0
+        self.next_snapshot = tracemalloc.get_traced_memory()[0] + min_growth
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+
+        while not self.done.wait(self.interval):
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            if current >= self.next_snapshot:
+                snapshot = array_snapshot()
+                self.arrays = largest_arrays(snapshot, self.before, self.top)
+                self.sampled = current
+                self.next_snapshot = max(current * self.growth, current + self.min_growth)
+                snapshot = None
+                tracemalloc.reset_peak()
+
+    def stop(self):
+        ''' return: the peak traced memory of the stage '''
+
+        self.done.set()
+        self.thread.join()
+        return max(self.peak, tracemalloc.get_traced_memory()[1])
+
+
+class MemoryProfiler(object):
+    '''
+    Peak traced memory and largest array allocations per stage and per page.
+
+    profiler.start_page(name) before each page, then profiler.save(path).
+    Peaks include the temporaries freed inside a stage. The largest arrays are
+    the ones alive at the peak of the stage ('arrays', taken when the traced
+    memory was 'arrays_at', see PeakSampler) and the ones still alive when it
+    ends ('kept'), each at the line of the pipeline which allocated them, so
+    nframes must reach from numpy back to it.
+    '''
+
+    def __init__(self, top=5, nframes=25):
+
+        self.top = top
+        self.nframes = nframes
+        self.pages = []
+        self.page = None
+
+    def start_page(self, name):
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.nframes)
+        self.page = {'name': name, 'peak': 0, 'stages': []}
+        self.pages.append(self.page)
+
+    @contextmanager
+    def stage(self, name):
+
+        if self.page is None:
+            self.start_page(None)
+
+        before = array_snapshot()
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        sampler = PeakSampler(before, self.top)
+        try:
+            yield
+        finally:
+            peak = sampler.stop()
+            after = array_snapshot()
+
+            self.page['stages'].append({
+                'stage': name,
+                'peak': peak,
+                'growth': peak - start,
+                'arrays': sampler.arrays,
+                'arrays_at': sampler.sampled,
+                'kept': largest_arrays(after, before, self.top),
+            })
+            self.page['peak'] = max(self.page['peak'], peak)
+
+    def worst_pages(self, n=10):
+        ''' The n pages with the highest peak '''
+
+        return sorted(self.pages, key=lambda page: page['peak'], reverse=True)[:n]
+
+    def save(self, report_file):
+
+        with open(report_file, 'w') as f:
+            json.dump({'pages': self.pages,
+                       'worst': [page['name'] for page in self.worst_pages()]},
+                      f, indent=1)
+
+
+class PageTiming(object):
+    ''' Wall time per stage of one page, see SlowPageCapture.start_page '''
+
+    def __init__(self, name, ids, budget, capture_dir):
+
+        self.budget = budget
+        self.capture_dir = capture_dir
+        self.page = {'name': name, 'ids': ids, 'seconds': 0.0, 'slow': False,
+                     'stages': []}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.page['stages'].append({'stage': name,
+                                        'seconds': time.perf_counter() - start})
+
+    def end(self, rerun=None):
+        '''
+        rerun: optional callable repeating the work of the page, profiled when
+               slow; give it a fresh deadline of the same budget, if any
+        return: the timings of the page, page['slow'] is True when over budget
+        '''
+        page = self.page
+        page['seconds'] = time.perf_counter() - self.start
+        page['slow'] = page['seconds'] > self.budget
+
+        if page['slow']:
+            os.makedirs(self.capture_dir, exist_ok=True)
+            path = os.path.join(self.capture_dir, str(page['name']))
+            if rerun is not None:
+                profile = cProfile.Profile()
+                profile.runcall(rerun)
+                profile.dump_stats(path + '.prof')
+                page['profile'] = path + '.prof'
+            with open(path + '.json', 'w') as f:
+                json.dump(page, f, indent=1)
+        return page
+
+
+class SlowPageCapture(object):
+    '''
+    Wall time per stage and per page, with a cProfile dump of the pages over budget.
+
+    timing = capture.start_page(name, **ids) before each page, run it with
+    profiler=timing, then capture.add_page(timing.end(rerun)). A page slower
+    than budget seconds is run again as rerun() under cProfile, and capture_dir
+    gets <name>.prof along with <name>.json (ids, page and stage times). Pages
+    within budget only pay for a few perf_counter calls.
+
+    Each page has its own timing, so pages can run in threads or in worker
+    processes; those only need the budget, see without_pages().
+    '''
+
+    def __init__(self, budget, capture_dir='slow_pages'):
+
+        self.budget = budget
+        self.capture_dir = capture_dir
+        self.pages = []
+
+    def start_page(self, name, **ids):
+
+        return PageTiming(name, ids, self.budget, self.capture_dir)
+
+    def without_pages(self):
+        ''' Same budget and capture_dir, no pages: cheap to send to a worker '''
+
+        return SlowPageCapture(self.budget, self.capture_dir)
+
+    def add_page(self, page):
+        ''' Record the timings of a page, as returned by PageTiming.end '''
+
+        self.pages.append(page)
+
+    def summary(self):
+        ''' Latency percentiles and the slow pages, slowest first '''
+
+        seconds = np.array([page['seconds'] for page in self.pages])
+        slow = sorted((page for page in self.pages if page['slow']),
+                      key=lambda page: page['seconds'], reverse=True)
+        percentiles = np.percentile(seconds, [50, 90, 99]) if len(seconds) else [0, 0, 0]
+        return {'pages': len(self.pages), 'budget': self.budget,
+                'p50': float(percentiles[0]), 'p90': float(percentiles[1]),
+                'p99': float(percentiles[2]),
+                'max': float(seconds.max()) if len(seconds) else 0.0,
+                'slow': [{'name': page['name'], 'seconds': page['seconds']}
+                         for page in slow]}
+
+    def save(self, report_file=None):
+        ''' report_file: defaults to summary.json in capture_dir '''
+
+        if report_file is None:
+            os.makedirs(self.capture_dir, exist_ok=True)
+            report_file = os.path.join(self.capture_dir, 'summary.json')
+        with open(report_file, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
@@ -0,0 +1,134 @@
+import json
+import os
+
+import numpy as np
+
+'''
+Compact result formats written next to the submission xml.
+
+A result directory holds one .npy file per column, every page is a slice
+of the box columns given by offsets:
+    names.npy    (P,)      page names
+    offsets.npy  (P + 1,)  int64, boxes of page i are offsets[i]:offsets[i + 1]
+    bboxs.npy    (N, 4)    int32, y0, x0, y1, x1
+    labels.npy   (N,)      int32
+    confs.npy    (N,)      float32
+Read it with ResultSet, memory-mapped by default.
+
+The json lines format has one page per line, written as soon as the page is
+done: {"name": ..., "bboxs": [[y0, x0, y1, x1], ...], "labels": [...], "confs": [...]}
+with "degraded": [stages] on runs with a page budget (see deadline.py).
+'''
+
+
+COLUMNS = ['bboxs', 'labels', 'confs']
+
+
+class ResultWriter(object):
+    ''' Collect the results of each page and save them as a result directory. '''
+
+    def __init__(self, result_dir):
+
+        self.result_dir = result_dir
+        self.names = []
+        self.bboxs = []
+        self.labels = []
+        self.confs = []
+
+    def add(self, name, bboxs, labels, confs, degraded=None):
+        ''' degraded is only kept by the json lines format '''
+
+        self.names.append(name)
+        self.bboxs.append(np.reshape(np.int32(bboxs), (-1, 4)))
+        self.labels.append(np.int32(labels))
+        self.confs.append(np.float32(confs))
+
+    def close(self):
+
+        os.makedirs(self.result_dir, exist_ok=True)
+        offsets = np.zeros(len(self.names) + 1, np.int64)
+        offsets[1:] = np.cumsum([len(labels) for labels in self.labels])
+
+        columns = {
+            'names': np.array(self.names, dtype=str),
+            'offsets': offsets,
+            'bboxs': np.concatenate(self.bboxs) if self.bboxs else np.zeros((0, 4), np.int32),
+            'labels': np.concatenate(self.labels) if self.labels else np.zeros(0, np.int32),
+            'confs': np.concatenate(self.confs) if self.confs else np.zeros(0, np.float32),
+        }
+        for key, value in columns.items():
+            np.save(os.path.join(self.result_dir, key + '.npy'), value)
+
+
+class JsonlWriter(object):
+    ''' Write the results of each page as one json line. '''
+
+    def __init__(self, jsonl_file):
+
+        self.f = open(jsonl_file, 'w')
+
+    def add(self, name, bboxs, labels, confs, degraded=None):
+        ''' degraded: stages which fell back to cheaper boxes, written when given '''
+
+        page = {'name': name,
+                'bboxs': np.int32(bboxs).tolist(),
+                'labels': np.int32(labels).tolist(),
+                'confs': np.float64(confs).tolist()}
+        if degraded is not None:
+            page['degraded'] = list(degraded)
+        self.f.write(json.dumps(page) + '\n')
+        self.f.flush()
+
+    def close(self):
+
+        self.f.close()
+
+
+class ResultSet(object):
+    '''
+    Results of a result directory. Columns are memory-mapped unless mmap=False,
+    and pages are returned as views of them.
+    '''
+
+    def __init__(self, result_dir, mmap=True):
+
+        mmap_mode = 'r' if mmap else None
+        self.names = np.load(os.path.join(result_dir, 'names.npy'))
+        self.offsets = np.load(os.path.join(result_dir, 'offsets.npy'))
+        self.bboxs, self.labels, self.confs = [
+            np.load(os.path.join(result_dir, key + '.npy'), mmap_mode=mmap_mode)
+            for key in COLUMNS]
+        self._index = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name):
+        ''' Position of a page given its name '''
+
+        if self._index is None:
+            self._index = {str(n): i for i, n in enumerate(self.names)}
+        return self._index[name]
+
+    def page(self, key):
+        ''' return: bboxs, labels, confs of a page given by position or name '''
+
+        i = self.index(key) if isinstance(key, str) else key
+        s = slice(self.offsets[i], self.offsets[i + 1])
+        return self.bboxs[s], self.labels[s], self.confs[s]
+
+    def __iter__(self):
+        ''' yield: name, bboxs, labels, confs '''
+
+        for i in range(len(self)):
+            yield (str(self.names[i]),) + self.page(i)
+
+
+def read_jsonl(jsonl_file):
+    ''' yield: name, bboxs, labels, confs of each line '''
+
+    with open(jsonl_file, 'r') as f:
+        for line in f:
+            page = json.loads(line)
+            yield (page['name'], np.reshape(np.int32(page['bboxs']), (-1, 4)),
+                   np.int32(page['labels']), np.float32(page['confs']))
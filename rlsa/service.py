@@ -0,0 +1,287 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from skimage import color
+
+from deadline import Deadline
+from post_process import load_page, process_one
+
+'''
+Local layout service for post_process.process_one.
+
+    python service.py --port 8000 --workers 4
+
+POST /layout
+    application/json          {"img_path": ..., "mask_path": ...}
+    application/octet-stream  npz bytes with arrays "img" (RGB or gray) and "mask"
+returns {"bboxs": [[y0, x0, y1, x1], ...], "labels": [...], "confs": [...]}
+or 503 when the queue is full, 504 when the result takes more than
+--request-timeout seconds. With --page-budget the result also has
+"degraded": [stages], the stages which fell back to cheaper boxes because the
+page ran over its budget, counted from when a worker picks it up.
+
+Worker processes are started once and warmed up, requests are grouped into
+small batches of same-size pages, split over the idle workers so that a
+batch never waits on one worker while others are free. When a worker
+dies (e.g. killed for its memory) the pages in flight get a 500 and the pool
+is started again.
+'''
+
+
+def warm_worker():
+    ''' Pay the import and first-call cost once per worker process. '''
+
+    mask = np.zeros((32, 32, 4))
+    mask[..., 0] = 1
+    process_one(np.ones((32, 32)), mask)
+
+
+def process_batch(pages, page_budget=None, mask_scale=1):
+    ''' Runs in a worker: process a batch of pages given by paths or arrays. '''
+
+    results = []
+    for page in pages:
+        deadline = Deadline(page_budget) if page_budget else None
+        try:
+            if 'img_path' in page:
+                _, img, mask = load_page(page['img_path'], page['mask_path'])
+            else:
+                img, mask = page['img'], page['mask']
+                if img.ndim == 3:
+                    img = color.rgb2gray(img)
+
+            bboxs, labels, confs = process_one(img, mask, deadline=deadline,
+                                               mask_scale=mask_scale)
+            result = {'bboxs': np.int32(bboxs).tolist(),
+                      'labels': np.int32(labels).tolist(),
+                      'confs': np.float64(confs).tolist()}
+            if deadline is not None:
+                result['degraded'] = deadline.degraded
+            results.append(result)
+        except Exception as e:
+            results.append({'error': '%s: %s' % (type(e).__name__, e)})
+    return results
+
+
+def page_shape(page):
+    ''' (height, width) of a page, only the image header is read for paths. '''
+
+    if 'img_path' in page:
+        with Image.open(page['img_path']) as img:
+            width, height = img.size
+        return height, width
+    return page['img'].shape[:2]
+
+
+class LayoutService(object):
+    ''' Pool of warm workers fed by a bounded queue and a batching thread. '''
+
+    def __init__(self, workers=4, max_queue=64, batch_size=8, batch_wait=0.005,
+                 page_budget=None, mask_scale=1):
+
+        self.workers = workers
+        self.pool = self._new_pool()
+        self.pool_lock = threading.Lock()
+        self.busy = 0  # batches submitted and not done, under pool_lock
+        self.requests = queue.Queue(max_queue)
+        # Batches sent to the pool but not finished, the batcher waits on it
+        # so a saturated pool fills the queue and submit starts failing.
+        self.in_flight = threading.BoundedSemaphore(2 * workers)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.page_budget = page_budget
+        self.mask_scale = mask_scale
+
+        self.running = True
+        self.batcher = threading.Thread(target=self._batch_loop, daemon=True)
+        self.batcher.start()
+
+    def submit(self, page):
+        ''' return a Future of the result, raise queue.Full when saturated '''
+
+        future = Future()
+        self.requests.put_nowait((page_shape(page), page, future))
+        return future
+
+    def _batch_loop(self):
+
+        while self.running:
+            try:
+                pending = [self.requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            # Collect whatever arrives within batch_wait.
+            stop = time.monotonic() + self.batch_wait
+            while len(pending) < self.batch_size:
+                remain = stop - time.monotonic()
+                if remain <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=remain))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for shape, page, future in pending:
+                groups.setdefault(shape, []).append((page, future))
+            for group in groups.values():
+                # One batch per idle worker, all workers when none is idle.
+                with self.pool_lock:
+                    idle = self.workers - self.busy
+                size = -(-len(group) // (idle if idle > 0 else self.workers))
+                for start in range(0, len(group), size):
+                    self._dispatch(group[start:start + size])
+
+    def _dispatch(self, group):
+
+        self.in_flight.acquire()
+        futures = [future for _, future in group]
+        pages = [page for page, _ in group]
+
+        with self.pool_lock:
+            pool = self.pool
+            self.busy += 1
+        try:
+            batch = pool.submit(process_batch, pages, self.page_budget, self.mask_scale)
+        except BrokenProcessPool as e:
+            batch = Future()
+            batch.set_exception(e)
+
+        def done(batch):
+            with self.pool_lock:
+                self.busy -= 1
+            self.in_flight.release()
+            try:
+                results = batch.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._restart(pool)
+                results = [{'error': '%s: %s' % (type(e).__name__, e)}] * len(futures)
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+        batch.add_done_callback(done)
+
+    def _new_pool(self):
+
+        pool = ProcessPoolExecutor(self.workers, initializer=warm_worker)
+        # The first task starts (and warms) the workers before any request.
+        pool.submit(int)
+        return pool
+
+    def _restart(self, broken):
+        ''' Replace a pool broken by a dead worker, once per broken pool '''
+
+        with self.pool_lock:
+            if self.pool is broken:
+                self.pool = self._new_pool()
+        broken.shutdown(wait=False)
+
+    def close(self):
+
+        self.running = False
+        self.batcher.join()
+        self.pool.shutdown()
+
+
+class LayoutHandler(BaseHTTPRequestHandler):
+
+    service = None
+    timeout_seconds = 60
+
+    def _send(self, code, obj, headers=()):
+
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        if self.path != '/health':
+            return self._send(404, {'error': 'not found'})
+        self._send(200, {'status': 'ok',
+                         'queued': self.service.requests.qsize()})
+
+    def do_POST(self):
+
+        if self.path != '/layout':
+            return self._send(404, {'error': 'not found'})
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                request = json.loads(body)
+                page = {'img_path': request['img_path'],
+                        'mask_path': request['mask_path']}
+            else:
+                arrays = np.load(BytesIO(body))
+                if not isinstance(arrays, np.lib.npyio.NpzFile):
+                    raise ValueError('expected npz bytes with arrays img and mask')
+                with arrays:
+                    page = {'img': arrays['img'], 'mask': arrays['mask']}
+            future = self.service.submit(page)
+        except queue.Full:
+            return self._send(503, {'error': 'queue full'}, [('Retry-After', '1')])
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            return self._send(400, {'error': '%s: %s' % (type(e).__name__, e)})
+
+        try:
+            result = future.result(timeout=self.timeout_seconds)
+        except TimeoutError:
+            return self._send(504, {'error': 'no result after %gs' % self.timeout_seconds})
+        self._send(500 if 'error' in result else 200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Local layout service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--batch-wait', type=float, default=0.005,
+                        help='seconds to wait for more pages of a batch')
+    parser.add_argument('--page-budget', type=float,
+                        help='seconds per page, slower pages fall back to cheaper boxes')
+    parser.add_argument('--request-timeout', type=float, default=60,
+                        help='seconds before a request is answered with 504')
+    parser.add_argument('--mask-scale', type=int, default=1,
+                        help='page pixels per mask cell, for masks at the network stride')
+    args = parser.parse_args()
+
+    LayoutHandler.timeout_seconds = args.request_timeout
+
+    LayoutHandler.service = LayoutService(args.workers, args.max_queue,
+                                          args.batch_size, args.batch_wait,
+                                          args.page_budget, args.mask_scale)
+    server = ThreadingHTTPServer((args.host, args.port), LayoutHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        LayoutHandler.service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import json
+import os
+import xml.dom.minidom
+
+import numpy as np
+from tqdm import tqdm
+
+from post_process import load_page, page_names, process_one, write_xml
+
+'''
+Sharded runs of post_process over several nodes.
+
+    python shard.py manifest ../pod_test/predictions+/ manifest.txt
+    python shard.py run manifest.txt --shards 4 --index 0 \\
+        --img-dir ../pod_test/images/ --mask-dir ../pod_test/predictions+/ \\
+        --output shard_0.json
+    python shard.py merge manifest.txt shard_*.json --output submission.xml
+
+Shard i processes every num_shards-th page of the manifest starting at i.
+The merge writes the pages in manifest order and checks that every page of
+the manifest is present exactly once.
+'''
+
+
+def write_manifest(mask_dir, manifest_file):
+    ''' Save the page list of mask_dir, one name per line. '''
+
+    with open(manifest_file, 'w') as f:
+        for name in page_names(mask_dir):
+            f.write(name + '\n')
+
+
+def read_manifest(manifest_file):
+    ''' return: page names and a digest identifying the manifest '''
+
+    with open(manifest_file, 'rb') as f:
+        data = f.read()
+    names = [line for line in data.decode('utf-8').splitlines() if line]
+    if len(set(names)) != len(names):
+        raise ValueError('duplicate pages in manifest %s' % manifest_file)
+    return names, hashlib.sha1(data).hexdigest()
+
+
+def shard_pages(names, num_shards, index):
+
+    if not 0 <= index < num_shards:
+        raise ValueError('shard index %d out of range for %d shards'
+                         % (index, num_shards))
+    return names[index::num_shards]
+
+
+def run_shard(manifest_file, num_shards, index, img_dir, mask_dir, output_file,
+              mask_scale=1):
+    ''' Process the pages of one shard and save them with the shard header. '''
+
+    names, digest = read_manifest(manifest_file)
+
+    pages = []
+    for name in tqdm(shard_pages(names, num_shards, index)):
+        _, img, mask = load_page(os.path.join(img_dir, name + '.jpg'),
+                                 os.path.join(mask_dir, name + '_prob.npy'))
+        bboxs, labels, confs = process_one(img, mask, mask_scale=mask_scale)
+        pages.append({'name': name,
+                      'bboxs': np.int32(bboxs).tolist(),
+                      'labels': np.int32(labels).tolist(),
+                      'confs': np.float64(confs).tolist()})
+
+    shard = {'manifest': digest, 'num_shards': num_shards,
+             'index': index, 'pages': pages}
+
+    # Write then rename, so a killed node never leaves a partial shard.
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(shard, f)
+    os.replace(tmp_file, output_file)
+
+
+def merge_shards(manifest_file, shard_files, output_file='submission.xml'):
+    ''' Combine shard results into one submission xml in manifest order. '''
+
+    names, digest = read_manifest(manifest_file)
+
+    shards = []
+    for shard_file in shard_files:
+        with open(shard_file, 'r') as f:
+            shards.append(json.load(f))
+    if not shards:
+        raise ValueError('no shard files given')
+
+    num_shards = shards[0]['num_shards']
+    for shard_file, shard in zip(shard_files, shards):
+        if shard['manifest'] != digest:
+            raise ValueError('%s was produced from another manifest' % shard_file)
+        if shard['num_shards'] != num_shards:
+            raise ValueError('%s has %d shards, expected %d'
+                             % (shard_file, shard['num_shards'], num_shards))
+
+    indexes = sorted(shard['index'] for shard in shards)
+    if indexes != list(range(num_shards)):
+        raise ValueError('shard indexes %s, expected 0..%d'
+                         % (indexes, num_shards - 1))
+
+    results = {}
+    duplicated = []
+    for shard in shards:
+        for page in shard['pages']:
+            if page['name'] in results:
+                duplicated.append(page['name'])
+            results[page['name']] = page
+
+    missing = [name for name in names if name not in results]
+    name_set = set(names)
+    unknown = [name for name in results if name not in name_set]
+    if duplicated or missing or unknown:
+        raise ValueError('bad shards: %d duplicated %s, %d missing %s, %d unknown %s'
+                         % (len(duplicated), duplicated[:5], len(missing),
+                            missing[:5], len(unknown), unknown[:5]))
+
+    doc = xml.dom.minidom.Document()
+    root = doc.createElement('')
+    doc.appendChild(root)
+
+    for name in names:
+        page = results[name]
+        write_xml(root, doc, name, np.int32(page['bboxs']).reshape((-1, 4)),
+                  np.int32(page['labels']), np.float32(page['confs']))
+
+    with open(output_file, 'w') as xml_file:
+        doc.writexml(xml_file, newl='\n', addindent='\t', encoding='UTF-8')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Sharded post process')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    manifest = commands.add_parser('manifest', help='list the pages of mask_dir')
+    manifest.add_argument('mask_dir')
+    manifest.add_argument('manifest')
+
+    run = commands.add_parser('run', help='process one shard')
+    run.add_argument('manifest')
+    run.add_argument('--shards', type=int, required=True)
+    run.add_argument('--index', type=int, required=True)
+    run.add_argument('--img-dir', required=True)
+    run.add_argument('--mask-dir', required=True)
+    run.add_argument('--output', required=True)
+    run.add_argument('--mask-scale', type=int, default=1,
+                     help='page pixels per mask cell, for masks at the network stride')
+
+    merge = commands.add_parser('merge', help='merge shards into the submission')
+    merge.add_argument('manifest')
+    merge.add_argument('shards', nargs='+')
+    merge.add_argument('--output', default='submission.xml')
+
+    args = parser.parse_args()
+    if args.command == 'manifest':
+        write_manifest(args.mask_dir, args.manifest)
+    elif args.command == 'run':
+        run_shard(args.manifest, args.shards, args.index,
+                  args.img_dir, args.mask_dir, args.output, args.mask_scale)
+    else:
+        merge_shards(args.manifest, args.shards, args.output)
+
+
+if __name__ == '__main__':
+    main()
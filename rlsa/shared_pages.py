@@ -0,0 +1,317 @@
+import argparse
+import functools
+import multiprocessing as mp
+import os
+import xml.dom.minidom
+from collections import deque
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+from skimage import color, io
+from tqdm import tqdm
+
+from post_process import page_names, process_one, write_xml
+
+'''
+Decode and compute in separate processes, pages handed over in shared memory.
+
+    python shared_pages.py ../pod_test/images/ ../pod_test/predictions+/ \\
+        --output submission.xml --decoders 2 --workers 4
+
+Decoder processes write the arrays of a page (RGB image, mask) into one slot
+of a ring of shared memory buffers; worker processes read them in place as
+numpy views and only send back the small box arrays. A slot belongs to a page
+from its decoding until its result is back, so the ring bounds the memory.
+
+The parent hands every task to one given process, so when a decoder or a
+worker dies its slot goes back to the ring, its page gets an error result and
+the process is replaced; an idle process that died is replaced as well. Slots are unlinked when the pipeline is closed.
+'''
+
+
+ALIGN = 64
+
+
+def write_arrays(buf, arrays):
+    '''
+    Copy a dict of arrays into buf.
+    return: layout [(key, shape, dtype, offset)], None when buf is too small
+    '''
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+        array = np.asarray(array)
+        offset = -(-offset // ALIGN) * ALIGN
+        layout.append((key, array.shape, array.dtype.str, offset))
+        offset += array.nbytes
+    if offset > len(buf):
+        return None
+
+    for (key, shape, dtype, offset), array in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype, buffer=buf, offset=offset)[...] = array
+    return layout
+
+
+def read_arrays(buf, layout):
+    ''' Views of the arrays written by write_arrays, nothing is copied '''
+
+    return {key: np.ndarray(shape, dtype, buffer=buf, offset=offset)
+            for key, shape, dtype, offset in layout}
+
+
+def decode_page(item):
+    ''' item: (img_path, mask_path); return: RGB image and mask '''
+
+    img_path, mask_path = item
+    return {'img': io.imread(img_path), 'mask': np.load(mask_path)}
+
+
+def process_page(arrays, mask_scale=1):
+    ''' post_process.process_one on the arrays of decode_page '''
+
+    img = arrays['img']
+    if img.ndim == 3:
+        img = color.rgb2gray(img)
+    bboxs, labels, confs = process_one(img, arrays['mask'], mask_scale=mask_scale)
+    return {'bboxs': bboxs, 'labels': labels, 'confs': confs}
+
+
+def decoder_loop(decode, slot_names, conn):
+
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    for index, item, slot in iter(conn.recv, None):
+        try:
+            arrays = decode(item)
+            layout = write_arrays(slots[slot].buf, arrays)
+            # Too large for a slot, the arrays go through the pipe instead.
+            if layout is None:
+                conn.send(('decoded', index, slot, None, arrays))
+            else:
+                conn.send(('decoded', index, slot, layout, None))
+        except Exception as e:
+            conn.send(('done', index, slot, {'error': '%s: %s' % (type(e).__name__, e)}))
+
+
+def worker_loop(process, slot_names, conn):
+
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    for index, slot, layout, arrays in iter(conn.recv, None):
+        try:
+            if arrays is None:
+                arrays = read_arrays(slots[slot].buf, layout)
+            result = process(arrays)
+        except Exception as e:
+            result = {'error': '%s: %s' % (type(e).__name__, e)}
+        # No view of the slot may outlive the page.
+        arrays = None
+        conn.send(('done', index, slot, result))
+
+
+class SharedPagePipeline(object):
+    '''
+    decode(item) -> dict of arrays, run by the decoders
+    process(arrays) -> small result, run by the workers on views of the slot
+    Both must be picklable, e.g. module level functions.
+
+    with SharedPagePipeline(decode_page, process_page) as pipeline:
+        for item, result in pipeline.imap(items): ...
+
+    Each process has its own pipe to the parent, so one that dies while
+    sending can not block the others.
+    '''
+
+    def __init__(self, decode=decode_page, process=process_page, decoders=1, workers=4,
+                 slots=None, slot_bytes=256 << 20):
+
+        self.decode = decode
+        self.process = process
+        num_slots = slots or workers + 2 * decoders
+        self.slots = [shared_memory.SharedMemory(create=True, size=slot_bytes)
+                      for _ in range(num_slots)]
+        self.slot_names = [slot.name for slot in self.slots]
+
+        # proc_id -> [kind, process, conn, task], task is (index, slot) or None
+        self.procs = {}
+        for i in range(decoders):
+            self._start('decoder', 'decoder_%d' % i)
+        for i in range(workers):
+            self._start('worker', 'worker_%d' % i)
+
+    def _start(self, kind, proc_id):
+
+        conn, child_conn = mp.Pipe()
+        target = decoder_loop if kind == 'decoder' else worker_loop
+        function = self.decode if kind == 'decoder' else self.process
+        proc = mp.Process(target=target, daemon=True,
+                          args=(function, self.slot_names, child_conn))
+        proc.start()
+        child_conn.close()
+        self.procs[proc_id] = [kind, proc, conn, None]
+
+    def _assign(self, proc_id, task, message):
+        ''' Send a task, to a new process when the idle one died meanwhile '''
+
+        for retry in (True, False):
+            self.procs[proc_id][3] = task
+            try:
+                self.procs[proc_id][2].send(message)
+                return
+            except (BrokenPipeError, OSError):
+                self.procs[proc_id][3] = None
+                if not retry:
+                    raise
+                self._replace(proc_id)
+
+    def _idle(self, kind):
+
+        return [proc_id for proc_id, (k, _, _, task) in self.procs.items()
+                if k == kind and task is None]
+
+    def _replace(self, proc_id):
+
+        kind, proc, conn, task = self.procs[proc_id]
+        proc.join()
+        conn.close()
+        self._start(kind, proc_id)
+
+    def _reap(self, proc_id, free_slots, results):
+        ''' Replace a dead process, recycle its slot and fail its page '''
+
+        kind, proc, conn, task = self.procs[proc_id]
+        if task is not None:
+            index, slot = task
+            free_slots.append(slot)
+            proc.join()
+            results[index] = {'error': '%s died with exit code %s'
+                              % (proc_id, proc.exitcode)}
+        self._replace(proc_id)
+
+    def imap(self, items):
+        ''' yield: (item, result) in input order, result is {'error': ...} on failure '''
+
+        items = iter(items)
+        inputs = {}
+        next_index = 0
+        next_yield = 0
+        exhausted = False
+
+        free_slots = deque(range(len(self.slots)))
+        decoded = deque()
+        results = {}
+
+        while True:
+
+            # Fill idle decoders while there are slots, then idle workers.
+            for proc_id in self._idle('decoder'):
+                if exhausted or not free_slots:
+                    break
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                slot = free_slots.popleft()
+                inputs[next_index] = item
+                self._assign(proc_id, (next_index, slot), (next_index, item, slot))
+                next_index += 1
+
+            for proc_id in self._idle('worker'):
+                if not decoded:
+                    break
+                index, slot, layout, arrays = decoded.popleft()
+                self._assign(proc_id, (index, slot), (index, slot, layout, arrays))
+
+            while next_yield in results:
+                yield inputs.pop(next_yield), results.pop(next_yield)
+                next_yield += 1
+            if exhausted and next_yield == next_index:
+                return
+
+            # Idle processes are watched too, one that dies is replaced
+            # before it gets a task.
+            procs = list(self.procs.items())
+            ready = wait([proc[2] for _, proc in procs if proc[3] is not None] +
+                         [proc[1].sentinel for _, proc in procs])
+
+            for proc_id, (kind, proc, conn, task) in procs:
+                try:
+                    event = conn.recv() if conn in ready else None
+                except EOFError:
+                    event = None
+                if event is not None:
+                    kind, index, slot = event[:3]
+                    self.procs[proc_id][3] = None
+                    if kind == 'decoded':
+                        decoded.append((index, slot) + event[3:])
+                    else:
+                        free_slots.append(slot)
+                        results[index] = event[3]
+                elif proc.sentinel in ready:
+                    self._reap(proc_id, free_slots, results)
+
+    def close(self):
+
+        for kind, proc, conn, task in self.procs.values():
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for kind, proc, conn, task in self.procs.values():
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+            conn.close()
+        self.procs = {}
+
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+        self.slots = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='post_process with decoding and processing in separate processes')
+    parser.add_argument('img_dir')
+    parser.add_argument('mask_dir')
+    parser.add_argument('--output', default='submission.xml')
+    parser.add_argument('--decoders', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--slots', type=int, help='default: workers + 2 * decoders')
+    parser.add_argument('--slot-mb', type=int, default=256,
+                        help='size of a slot, larger pages are sent through the pipes')
+    parser.add_argument('--mask-scale', type=int, default=1,
+                        help='page pixels per mask cell, for masks at the network stride')
+    args = parser.parse_args()
+
+    names = page_names(args.mask_dir)
+    items = [(os.path.join(args.img_dir, name + '.jpg'),
+              os.path.join(args.mask_dir, name + '_prob.npy')) for name in names]
+
+    doc = xml.dom.minidom.Document()
+    root = doc.createElement('')
+    doc.appendChild(root)
+
+    process = functools.partial(process_page, mask_scale=args.mask_scale)
+    with SharedPagePipeline(decode_page, process, args.decoders, args.workers,
+                            args.slots, args.slot_mb << 20) as pipeline:
+        for name, (item, result) in tqdm(zip(names, pipeline.imap(items)), total=len(names)):
+            if 'error' in result:
+                raise RuntimeError('%s: %s' % (name, result['error']))
+            write_xml(root, doc, name, result['bboxs'], result['labels'], result['confs'])
+
+    with open(args.output, 'w') as xml_file:
+        doc.writexml(xml_file, newl='\n', addindent='\t', encoding='UTF-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import csv
+import itertools
+
+import cv2
+import numpy as np
+from skimage import io
+from tqdm import tqdm
+
+from boxset import BoxSet
+from my_post_process import (rlsa_runs, rlsa_fill, bbox_from_rlsa,
+                             bbox_from_mask, merge_text_boxes, load_mask, page_sources)
+
+'''
+Parameter sweep for my_post_process.process_one.
+
+Every combination of the grid is evaluated per page in one pass, sharing the
+intermediates of the pipeline:
+    binarization and horizontal runs    once per page
+    vertical runs                       once per rlsa_thresh_h
+    labeling of text / formula          once per (rlsa_thresh_h, rlsa_thresh_v)
+    table / figure boxes                once per page
+so only the list merges are paid for each value1 / value2 / thresh setting.
+'''
+
+
+DEFAULT_PARAMS = {'rlsa_thresh_h': 15, 'rlsa_thresh_v': 8,
+                  'value1': 15, 'value2': 8, 'thresh': 50}
+PARAM_NAMES = list(DEFAULT_PARAMS)
+
+
+def expand_grid(grid):
+    ''' grid: {param: [values]}, missing params use DEFAULT_PARAMS '''
+
+    unknown = set(grid) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError('unknown sweep parameters: %s' % sorted(unknown))
+
+    values = [list(grid.get(k, [DEFAULT_PARAMS[k]])) for k in PARAM_NAMES]
+    return [dict(zip(PARAM_NAMES, v)) for v in itertools.product(*values)]
+
+
+def sweep_one(img, mask, grid):
+    '''
+    Evaluate all combinations of grid on one page.
+    return: list of (config, boxes, labels), same boxes as process_one(img, mask, **config)
+    '''
+    configs = expand_grid(grid)
+
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    (_, image_binary) = cv2.threshold(
+        gray, 150, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    mask_classes = np.argmax(mask, axis=2)
+
+    table_boxes = bbox_from_mask(mask, 2, mask_classes)
+    figure_boxes = bbox_from_mask(mask, 3, mask_classes)
+
+    runs_h = rlsa_runs(image_binary)
+    img_h = {}
+    runs_v = {}
+    labeled = {}
+    merged = {}
+    results = []
+    for config in configs:
+        h, v = config['rlsa_thresh_h'], config['rlsa_thresh_v']
+
+        # Vertical runs are taken on the horizontal result, so once per h.
+        if h not in runs_v:
+            img_h[h] = rlsa_fill(image_binary, runs_h, h).T
+            runs_v[h] = rlsa_runs(img_h[h])
+
+        if (h, v) not in labeled:
+            img_rlsa = rlsa_fill(img_h[h], runs_v[h], v).T
+            labeled[(h, v)] = (bbox_from_rlsa(img_rlsa, mask, 1, mask_classes),
+                               bbox_from_rlsa(img_rlsa, mask, 4, mask_classes))
+        text_rlsa_boxes, formula_rlsa_boxes = labeled[(h, v)]
+
+        key = (h, v, config['value1'], config['value2'], config['thresh'])
+        if key not in merged:
+            merged[key] = merge_text_boxes(text_rlsa_boxes, config['value1'],
+                                           config['value2'], config['thresh'])
+        text_boxes = merged[key]
+
+        boxes = BoxSet.concatenate((text_boxes, table_boxes,
+                                    figure_boxes, formula_rlsa_boxes))
+        results.append((config, boxes.bboxs, boxes.labels))
+
+    return results
+
+
+def sweep_all(img_dir, grid, output_file='sweep.csv'):
+    '''
+    Sweep every page in img_dir (name.jpg with its mask name.npy or name.png, see
+    my_post_process.page_sources) and save a table with one row per box: page,
+    parameters, label, bbox.
+    '''
+    pages = page_sources(img_dir)
+
+    with open(output_file, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['name'] + PARAM_NAMES +
+                        ['label', 'y0', 'x0', 'y1', 'x1'])
+
+        for name, img_path, mask_path in tqdm(pages):
+            img = io.imread(img_path)
+            mask = load_mask(mask_path)
+
+            for config, boxes, labels in sweep_one(img, mask, grid):
+                params = [config[k] for k in PARAM_NAMES]
+                for bbox, label in zip(boxes.tolist(), labels.tolist()):
+                    writer.writerow([name] + params + [label] + bbox)
+
+
+if __name__ == '__main__':
+
+    img_dir = '../img/'
+    grid = {'rlsa_thresh_h': [10, 15, 20, 25],
+            'rlsa_thresh_v': [4, 8, 12],
+            'value1': [10, 15],
+            'value2': [8],
+            'thresh': [30, 50]}
+
+    sweep_all(img_dir, grid, output_file='sweep.csv')
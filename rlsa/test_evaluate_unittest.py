@@ -0,0 +1,95 @@
+import math
+import unittest
+
+import numpy as np
+
+from evaluate import Boxes, average_precision, evaluate, match_page
+
+# One page. Figure (1): two ground truth boxes, found by a prediction, its
+# duplicate and a looser box of IoU 100 / 160 = 0.625. Table (2): a
+# prediction but no ground truth. Equation (3): ground truth, no prediction.
+GT_BBOXS = [[0, 0, 10, 10], [20, 20, 30, 30], [50, 50, 60, 60]]
+GT_LABELS = [1, 1, 3]
+PRED_BBOXS = [[20, 20, 30, 36], [0, 0, 10, 10], [0, 0, 10, 10], [70, 70, 80, 80]]
+PRED_LABELS = [1, 1, 1, 2]
+PRED_CONFS = [0.7, 0.9, 0.8, 0.5]
+THRESHOLDS = (0.5, 0.7)
+
+
+class TestEvaluate(unittest.TestCase):
+    ''' Precision, recall and AP of a few boxes, computed by hand '''
+
+    def setUp(self):
+        self.gt = Boxes(['page'], [0] * 3, GT_BBOXS, GT_LABELS, np.ones(3))
+        self.pred = Boxes(['page'], [0] * 4, PRED_BBOXS, PRED_LABELS, PRED_CONFS)
+
+    def test_average_precision(self):
+        """
+        All-point interpolation: area under the precision envelope
+        """
+        self.assertAlmostEqual(average_precision(np.array([0.5, 0.5, 1.0]),
+                                                 np.array([1.0, 0.5, 2 / 3])), 0.5 + 0.5 * 2 / 3)
+        self.assertAlmostEqual(average_precision(np.array([0.5, 1.0]),
+                                                 np.array([0.5, 1.0])), 1.0)
+        self.assertEqual(average_precision(np.zeros(0), np.zeros(0)), 0.0)
+
+    def test_match_page(self):
+        """
+        Predictions in descending confidence, the duplicate is a false positive,
+        the loose box only a true positive at IoU 0.5
+        """
+        matches = match_page((self.gt.bboxs, self.gt.labels, self.pred.bboxs,
+                              self.pred.labels, self.pred.confs, THRESHOLDS))
+        confs, tp, num_gt = matches[1]
+        self.assertEqual(confs.tolist(), [0.9, 0.8, 0.7])
+        self.assertEqual(tp.tolist(), [[True, False, True], [True, False, False]])
+        self.assertEqual(num_gt, 2)
+        self.assertEqual((matches[2][1].shape, matches[2][2]), ((2, 1), 0))
+        self.assertEqual((matches[3][1].shape, matches[3][2]), ((2, 0), 1))
+
+    def test_evaluate(self):
+        """
+        Per class and threshold; no ground truth gives an AP of nan
+        """
+        results = evaluate(self.gt, self.pred, THRESHOLDS)
+
+        figure = results[('figure', 0.5)]
+        self.assertAlmostEqual(figure['precision'], 2 / 3)
+        self.assertAlmostEqual(figure['recall'], 1.0)
+        self.assertAlmostEqual(figure['f1'], 0.8)
+        self.assertAlmostEqual(figure['ap'], 0.5 + 0.5 * 2 / 3)
+
+        figure = results[('figure', 0.7)]
+        self.assertAlmostEqual(figure['precision'], 1 / 3)
+        self.assertAlmostEqual(figure['recall'], 0.5)
+        self.assertAlmostEqual(figure['ap'], 0.5)
+
+        for thresh in THRESHOLDS:
+            self.assertTrue(math.isnan(results[('table', thresh)]['ap']))
+            self.assertEqual(results[('table', thresh)]['precision'], 0)
+            self.assertEqual(results[('equation', thresh)]['ap'], 0)
+            self.assertEqual(results[('equation', thresh)]['recall'], 0)
+
+    def test_workers(self):
+        """
+        Pages split into ranges over worker processes give the same results
+        """
+        rng = np.random.RandomState(0)
+        n, per = 50, 3
+        page = np.repeat(np.arange(n), per)
+        yx = rng.randint(0, 100, (n * per, 2))
+        bboxs = np.concatenate([yx, yx + rng.randint(5, 30, (n * per, 2))], axis=1)
+        gt = Boxes(range(n), page, bboxs, rng.randint(1, 4, n * per), np.ones(n * per))
+        pred = Boxes(range(n), page, bboxs + rng.randint(-3, 4, bboxs.shape),
+                     rng.randint(1, 4, n * per), rng.random_sample(n * per))
+
+        serial = evaluate(gt, pred, THRESHOLDS)
+        parallel = evaluate(gt, pred, THRESHOLDS, workers=3)
+        self.assertEqual(serial.keys(), parallel.keys())
+        for key in serial:
+            for name in serial[key]:
+                self.assertAlmostEqual(serial[key][name], parallel[key][name])
+
+
+if __name__ == '__main__':
+    unittest.main()
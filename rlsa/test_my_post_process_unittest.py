@@ -0,0 +1,190 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from boxset import BoxSet
+from my_post_process import (PreForRowMerge, ink_integral, ink_segments, iteration, layout_one,
+                             rlsa, rlsa_fast, rlsa_fill, rlsa_runs, xy_cut)
+
+
+def random_binary(rng, shape, ink=0.3):
+    ''' 0 (ink) or 255 pixels, uint8 like the binarized pages '''
+
+    return np.where(rng.random_sample(shape) < ink, 0, 255).astype(np.uint8)
+
+
+def pre_for_row_merge_list(boxes, thresh=50):
+    ''' PreForRowMerge as it was on lists of boxes, the reference '''
+
+    boxes = sorted(boxes, key=lambda x: x[1])
+    N = len(boxes)
+    if N <= 1:
+        return boxes
+    tmp = []
+    out_boxes = []
+    tmp.append(boxes[0])
+    for i in range(1, N):
+        A = boxes[i-1]
+        B = boxes[i]
+        if abs(B[1]-A[1]) < thresh:
+            tmp.append(B)
+        else:
+            tmp = sorted(tmp, key=lambda x: x[0])
+            out_boxes += tmp
+            tmp = [B]
+    out_boxes += tmp
+    return out_boxes
+
+
+class TestRLSAFast(unittest.TestCase):
+    ''' The run based rlsa against the pixel by pixel one, on random images '''
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_fill_same_as_iteration(self):
+        """
+        rlsa_fill on the runs of an image == iteration on a copy, for any value
+        """
+        for _ in range(50):
+            shape = tuple(self.rng.randint(1, 40, size=2))
+            image = random_binary(self.rng, shape, self.rng.uniform(0.05, 0.9))
+            runs = rlsa_runs(image)
+            for value in [-1, 0, 1, 2, 5, 15, 50]:
+                expected = iteration(image.copy(), max(value, 0))
+                self.assertEqual(rlsa_fill(image, runs, value).tolist(), expected.tolist())
+
+    def test_fast_same_as_rlsa(self):
+        """
+        rlsa_fast == rlsa for every direction, and leaves its input alone
+        """
+        for _ in range(50):
+            shape = tuple(self.rng.randint(1, 40, size=2))
+            image = random_binary(self.rng, shape, self.rng.uniform(0.05, 0.9))
+            before = image.copy()
+            value = self.rng.randint(0, 20)
+            for horizontal, vertical in [(True, False), (False, True), (True, True)]:
+                expected = rlsa(image.copy(), horizontal, vertical, value)
+                self.assertEqual(rlsa_fast(image, horizontal, vertical, value).tolist(),
+                                 expected.tolist())
+            self.assertEqual(image.tolist(), before.tolist())
+
+    def test_fast_with_executor(self):
+        """
+        Rows split into bands on a thread pool give the same image
+        """
+        with ThreadPoolExecutor(3) as executor:
+            for _ in range(5):
+                image = random_binary(self.rng, (300, 257))
+                value = self.rng.randint(1, 20)
+                self.assertEqual(rlsa_fast(image, True, True, value, executor).tolist(),
+                                 rlsa(image.copy(), True, True, value).tolist())
+
+    def test_no_zero(self):
+        """
+        Rows without ink have no run to fill
+        """
+        image = np.full((4, 9), 255, np.uint8)
+        image[2, 3] = 0
+        self.assertEqual(rlsa_fast(image, True, True, 5).tolist(),
+                         rlsa(image.copy(), True, True, 5).tolist())
+
+
+class TestPreForRowMerge(unittest.TestCase):
+    ''' The vectorized PreForRowMerge against the list sort, on random boxes '''
+
+    def test_same_as_list_sort(self):
+        """
+        Same order of boxes, ties and the unsorted last set included
+        """
+        rng = np.random.RandomState(0)
+        for n in list(range(6)) + [20, 100] * 10:
+            # Few distinct coordinates, so equal keys and set borders are common.
+            y0 = rng.randint(0, 300, n) // 10 * 10
+            x0 = rng.randint(0, 600, n) // 25 * 25
+            bboxs = np.stack([y0, x0, y0 + rng.randint(1, 40, n),
+                              x0 + rng.randint(1, 200, n)], axis=1)
+            boxes = BoxSet.from_arrays(bboxs, np.arange(n))
+
+            expected = pre_for_row_merge_list(list(bboxs))
+            self.assertEqual(PreForRowMerge(boxes).bboxs.tolist(),
+                             np.reshape(expected, (-1, 4)).tolist())
+
+
+def paragraph(ink, y0, y1, x0, x1):
+    ''' Lines of ink every 3 rows, words of 7 columns 3 apart; return: its box '''
+
+    rows = np.arange(y0, y1, 3)
+    cols = np.arange(x0, x1)[(np.arange(x0, x1) - x0) % 10 < 7]
+    ink[np.ix_(rows, cols)] = True
+    return (rows[0], cols[0], rows[-1] + 1, cols[-1] + 1)
+
+
+class TestXYCut(unittest.TestCase):
+    '''
+    Two columns of two paragraphs. Empty runs: 2 rows between lines, 3 columns
+    between words, 16 and 13 rows between the paragraphs of the left and the
+    right column, 7 rows between the paragraphs across the columns and 20
+    columns between the columns.
+    '''
+
+    def setUp(self):
+        self.ink = np.zeros((100, 120), bool)
+        self.left = [paragraph(self.ink, 10, 31, 10, 40), paragraph(self.ink, 45, 71, 10, 40)]
+        self.right = [paragraph(self.ink, 10, 25, 57, 97), paragraph(self.ink, 36, 81, 57, 97)]
+        self.S = ink_integral(self.ink)
+
+    def span(self, boxes):
+        return (boxes[0][0], boxes[0][1], boxes[-1][2], boxes[-1][3])
+
+    def test_ink_segments(self):
+        """
+        Split at min_gap empty entries or more, empty ends trimmed
+        """
+        profile = np.array([0, 1, 1, 0, 0, 1, 0, 0, 0, 1, 0])
+        self.assertEqual([v.tolist() for v in ink_segments(profile, 2)], [[1, 5, 9], [3, 6, 10]])
+        self.assertEqual([v.tolist() for v in ink_segments(profile, 3)], [[1, 9], [6, 10]])
+        self.assertEqual([v.tolist() for v in ink_segments(profile, 4)], [[1], [10]])
+        self.assertEqual([v.tolist() for v in ink_segments(np.zeros(5), 1)], [[], []])
+
+    def test_paragraphs(self):
+        """
+        Columns then paragraphs, tight boxes in reading order
+        """
+        self.assertEqual(xy_cut(self.S, 8, 18), self.left + self.right)
+        self.assertEqual(xy_cut(self.S, 13, 20), self.left + self.right)
+
+    def test_gaps(self):
+        """
+        A gap is cut when it is at least as long as row_gap / col_gap
+        """
+        # 13 rows between the right paragraphs are not enough for 14.
+        self.assertEqual(xy_cut(self.S, 14, 18), self.left + [self.span(self.right)])
+        # 20 columns are not enough for 21, the page is one block.
+        self.assertEqual(xy_cut(self.S, 8, 21), [self.span([self.left[0], self.right[1]])])
+        # 7 rows cut the page in two bands before the columns.
+        self.assertEqual(xy_cut(self.S, 7, 18),
+                         [self.left[0], self.right[0], self.left[1], self.right[1]])
+
+    def test_layout_gaps(self):
+        """
+        layout_one cuts columns at max(rlsa_thresh_h, value1 + 3) empty columns
+        """
+        img = np.where(self.ink, 0, 255).astype(np.uint8)[..., None].repeat(3, axis=2)
+        mask = np.zeros(self.ink.shape + (5,), np.uint8)
+        mask[..., 1] = 255
+
+        # Lines of a column go through the row merge as usual.
+        columns = [list(self.span(self.left)), list(self.span(self.right))]
+        self.assertEqual(layout_one(img, mask, engine='xycut')[0].tolist(), columns)
+        self.assertEqual(layout_one(img, mask, engine='xycut', value1=17)[0].tolist(), columns)
+        self.assertEqual(layout_one(img, mask, engine='xycut', rlsa_thresh_h=20)[0].tolist(),
+                         columns)
+        for kwargs in [{'value1': 18}, {'rlsa_thresh_h': 21}]:
+            self.assertEqual(layout_one(img, mask, engine='xycut', **kwargs)[0].tolist(),
+                             [list(self.span([self.left[0], self.right[1]]))])
+
+
+if __name__ == '__main__':
+    unittest.main()
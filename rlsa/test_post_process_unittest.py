@@ -0,0 +1,84 @@
+import unittest
+
+import numpy as np
+
+from boxset import BoxSet
+from post_process import bbox_overlap
+
+
+def bbox_overlap_loop(bboxs, labels, confs, overlap_thresh=0.8, small_thresh=30):
+    ''' bbox_overlap as it was, pairwise loops and one deletion at a time, the reference '''
+
+    areas = (bboxs[:, 2] - bboxs[:, 0]) * (bboxs[:, 3] - bboxs[:, 1])
+
+    bboxs = bboxs[areas > small_thresh, :]
+    labels = labels[areas > small_thresh]
+    confs = confs[areas > small_thresh]
+    areas = areas[areas > small_thresh]
+
+    if len(bboxs) <= 1:
+        return bboxs, labels, confs
+
+    overlap = np.zeros((bboxs.shape[0], bboxs.shape[0]))
+    for i, (bbox1, label1) in enumerate(zip(bboxs, labels)):
+        for j, (bbox2, label2) in enumerate(zip(bboxs, labels)):
+            if label1 != label2 or i == j:
+                continue
+            overlap_width = np.min((bbox1[2], bbox2[2])) - \
+                np.max((bbox1[0], bbox2[0]))
+            overlap_height = np.min((bbox1[3], bbox2[3])) - \
+                np.max((bbox1[1], bbox2[1]))
+            overlap_area = np.max((overlap_height, 0)) * \
+                np.max((overlap_width, 0))
+            overlap[i, j] = overlap_area / np.float32(areas[i])
+
+    while True:
+        idx = np.where(overlap > overlap_thresh)
+        if len(idx[0]) == 0:
+            break
+
+        delete_idx = idx[0][0]
+        overlap = np.delete(overlap, delete_idx, axis=0)
+        overlap = np.delete(overlap, delete_idx, axis=1)
+
+        bboxs = np.delete(bboxs, delete_idx, axis=0)
+        labels = np.delete(labels, delete_idx)
+        confs = np.delete(confs, delete_idx)
+
+    return bboxs, labels, confs
+
+
+def random_boxes(rng, n):
+    ''' n boxes of 3 classes, many nested or repeated so that overlaps are common '''
+
+    y0 = rng.randint(0, 200, n)
+    x0 = rng.randint(0, 200, n)
+    bboxs = np.stack([y0, x0, y0 + rng.randint(1, 80, n), x0 + rng.randint(1, 80, n)], axis=1)
+    # Copy some boxes, shrunk a little or not at all, onto others.
+    inner = rng.randint(0, n, n // 3)
+    bboxs[rng.randint(0, n, n // 3)] = bboxs[inner] + rng.randint(0, 3, (len(inner), 1)) * [1, 1, -1, -1]
+    labels = rng.randint(1, 4, n)
+    confs = rng.random_sample(n)
+    return np.int32(bboxs), np.int32(labels), np.float32(confs)
+
+
+class TestBBoxOverlap(unittest.TestCase):
+    ''' The vectorized bbox_overlap against the deletion loop, on random box sets '''
+
+    def test_same_as_loop(self):
+        """
+        Same boxes kept, in the same order, for several thresholds
+        """
+        rng = np.random.RandomState(0)
+        for n in list(range(5)) + [10, 30, 60] * 10:
+            bboxs, labels, confs = random_boxes(rng, n)
+            for overlap_thresh in [0.5, 0.8]:
+                expected = bbox_overlap_loop(bboxs, labels, confs, overlap_thresh)
+                boxes = bbox_overlap(BoxSet.from_arrays(bboxs, labels, confs), overlap_thresh)
+                self.assertEqual(boxes.bboxs.tolist(), expected[0].tolist())
+                self.assertEqual(boxes.labels.tolist(), expected[1].tolist())
+                self.assertEqual(boxes.confs.tolist(), expected[2].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
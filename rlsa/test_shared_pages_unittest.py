@@ -0,0 +1,71 @@
+import os
+import signal
+import unittest
+
+import numpy as np
+
+from shared_pages import SharedPagePipeline
+
+
+def decode_number(item):
+    ''' A small "page" holding item, in place of an image and a mask '''
+
+    return {'page': np.full((8, 8), item, np.int64)}
+
+
+def sum_page(arrays):
+    ''' Sum of the page; page 13 kills the worker running it '''
+
+    if arrays['page'][0, 0] == 13:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return {'sum': int(arrays['page'].sum())}
+
+
+class TestSharedPagePipeline(unittest.TestCase):
+    ''' Results in order, and dead processes replaced without blocking '''
+
+    def setUp(self):
+        self.pipeline = SharedPagePipeline(decode_number, sum_page, decoders=1,
+                                           workers=2, slot_bytes=1 << 16)
+
+    def tearDown(self):
+        self.pipeline.close()
+
+    def test_results_in_order(self):
+        """
+        Every page gets its result, in input order
+        """
+        items = list(range(12))
+        results = list(self.pipeline.imap(items))
+        self.assertEqual([item for item, _ in results], items)
+        self.assertEqual([result['sum'] for _, result in results],
+                         [64 * item for item in items])
+
+    def test_worker_dies_while_busy(self):
+        """
+        The page of a dead worker gets an error, the other pages their result
+        """
+        items = [1, 2, 13, 4, 5, 6]
+        results = dict(self.pipeline.imap(items))
+        self.assertIn('died', results[13]['error'])
+        self.assertEqual({item: results[item]['sum'] for item in items if item != 13},
+                         {item: 64 * item for item in items if item != 13})
+        self.assertEqual(len(self.pipeline.procs), 3)
+
+    def test_worker_dies_while_idle(self):
+        """
+        A worker killed between two imap calls is replaced before its next page
+        """
+        self.assertEqual(len(list(self.pipeline.imap([1, 2]))), 2)
+        for kind, proc, conn, task in list(self.pipeline.procs.values()):
+            os.kill(proc.pid, signal.SIGKILL)
+            proc.join()
+
+        results = list(self.pipeline.imap(list(range(8))))
+        self.assertEqual([result['sum'] for _, result in results],
+                         [64 * item for item in range(8)])
+        self.assertTrue(all(proc.is_alive() for _, proc, _, _ in self.pipeline.procs.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()